@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+
+# Benchmark of certificate renewals with `libarkcert`
+#
+# This renews a number of leaf certificates signed by the same CA the way
+# the `renew_certificate` Lambda function does, with the private keys of the
+# next certificates generated in the background by 1, 2, 4 and 6 worker
+# processes, and reports the number of certificates renewed per second. The
+# Parameter Store and IAM are replaced by in-process stand-ins, so no AWS
+# account is needed.
+#
+# With DSA keys, each run is done twice: without the DSA parameters cache
+# (i.e. new domain parameters are generated for each key) and with it, the
+# parameters having been saved by a previous invocation.
+#
+# Examples:
+#
+#     ./bench.py
+#     ./bench.py --count 50 --key-size 4096 --workers 1,2
+#     ./bench.py --reuse-key --workers 1
+#     ./bench.py --key-type EC --curve P-384
+#     ./bench.py --key-type DSA --key-size 2048 --count 10 --workers 1
+#
+# NB: This requires the `boto3` and `cryptography` packages. The speed-up is
+#     bounded by the number of CPUs of the machine running the benchmark.
+
+import argparse
+import os
+import platform
+import time
+
+import libarkcert
+
+
+class FakeSSM:
+    """Minimal in-memory SSM Parameter Store"""
+
+    class exceptions:
+        class ParameterNotFound(Exception):
+            pass
+
+        class ParameterAlreadyExists(Exception):
+            pass
+
+    class meta:
+        partition = "aws"
+        region_name = "us-east-1"
+
+    def __init__(self):
+        self.parameters = {}
+        self.tags = {}
+
+    def put_parameter(self, Name, Value, Description, Type, Overwrite, Tier=None):
+        if Name in self.parameters and not Overwrite:
+            raise self.exceptions.ParameterAlreadyExists(Name)
+        version = self.parameters[Name]['Version'] + 1 if Name in self.parameters else 1
+        self.parameters[Name] = {
+            'Name': Name,
+            'Value': Value,
+            'Type': Type,
+            'Version': version,
+            'ARN': f"arn:aws:ssm:us-east-1:123456789012:parameter{Name}"
+        }
+        return {'Version': version}
+
+    def get_parameter(self, Name, WithDecryption=False):
+        if Name not in self.parameters:
+            raise self.exceptions.ParameterNotFound(Name)
+        return {'Parameter': dict(self.parameters[Name])}
+
+    def get_parameters(self, Names, WithDecryption=False):
+        return {
+            'Parameters': [dict(self.parameters[name]) for name in Names if name in self.parameters],
+            'InvalidParameters': [name for name in Names if name not in self.parameters]
+        }
+
+    def list_tags_for_resource(self, ResourceType, ResourceId):
+        return {'TagList': list(self.tags.get(ResourceId, []))}
+
+    def remove_tags_from_resource(self, ResourceType, ResourceId, TagKeys):
+        self.tags[ResourceId] = [tag for tag in self.tags.get(ResourceId, []) if tag['Key'] not in TagKeys]
+        return {}
+
+    def add_tags_to_resource(self, ResourceType, ResourceId, Tags):
+        self.tags.setdefault(ResourceId, []).extend(Tags)
+        return {}
+
+
+class FakeIAM:
+    """Minimal in-memory IAM server certificate store"""
+
+    class exceptions:
+        class EntityAlreadyExistsException(Exception):
+            pass
+
+    def upload_server_certificate(self, Path, ServerCertificateName, **kwargs):
+        arn = f"arn:aws:iam::123456789012:server-certificate{Path}{ServerCertificateName}"
+        return {'ServerCertificateMetadata': {'Arn': arn}}
+
+    def delete_server_certificate(self, ServerCertificateName):
+        return {}
+
+
+class FakeSTS:
+    def get_caller_identity(self):
+        return {'Account': "123456789012"}
+
+
+class FakeSession:
+    def __init__(self):
+        self.clients = {'ssm': FakeSSM(), 'iam': FakeIAM(), 'sts': FakeSTS()}
+
+    def client(self, service):
+        return self.clients[service]
+
+
+def renew(session, certificates, workers, dsa_cache=True):
+    """Renew the given certificates like `renew_certificate.handler()`, with
+    `workers` processes generating the private keys in the background
+
+    If `dsa_cache` is `False`, the DSA parameters are generated again for
+    each certificate.
+    """
+    keygen = libarkcert.KeyGenerator(workers)
+    try:
+        for i, args in enumerate(certificates):
+            if not dsa_cache:
+                libarkcert.dsa_parameters_cache.clear()
+            for next_index in range(i, min(i + keygen.workers, len(certificates))):
+                next_args = certificates[next_index]
+                if not next_args.get('ReuseKey', False):
+                    keygen.prefetch(next_index, next_args['KeyType'], next_args['KeySize'], next_args.get('Curve'))
+            libarkcert.create_or_renew_cert(dict(args), session, keygen.get(i))
+    finally:
+        keygen.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark certificate renewals")
+    parser.add_argument("--count", type=int, default=24,
+                        help="Number of certificates to renew per run (default: %(default)s)")
+    parser.add_argument("--key-type", default="RSA", help="Key type (default: %(default)s)")
+    parser.add_argument("--key-size", type=int, default=3072, help="Key size (default: %(default)s)")
+    parser.add_argument("--curve", default="P-256", help="Curve of EC keys (default: %(default)s)")
+    parser.add_argument("--workers", default="1,2,4,6",
+                        help="Comma-separated numbers of key generation workers (default: %(default)s)")
+    parser.add_argument("--reuse-key", action="store_true",
+                        help="Keep the existing private keys, once created by a first run")
+    args = parser.parse_args()
+
+    # Keep `libarkcert` quiet, except for the results
+    libarkcert.print = lambda *a, **kw: None
+
+    # Save the DSA parameters in the fake Parameter Store too
+    session = FakeSession()
+    libarkcert.boto3 = session
+    os.environ['DSA_PARAMETERS_PATH'] = "/bench/pki/dsa-parameters"
+    libarkcert.create_or_renew_cert({
+        'KeyType': "RSA",
+        'KeySize': 2048,
+        'ValidityDays': 365,
+        'CommonName': "Benchmark CA",
+        'SelfSigned': True,
+        'BasicConstraints': {'CA': True},
+        'KeyParameterName': "/bench/pki/private/ca",
+        'CertParameterName': "/bench/pki/certs/ca"
+    }, session)
+    certificates = [
+        {
+            'KeyType': args.key_type,
+            'KeySize': args.key_size,
+            'Curve': args.curve,
+            'ValidityDays': 90,
+            'CommonName': f"leaf-{i}.bench.internal",
+            'CaKeyParameterName': "/bench/pki/private/ca",
+            'CaCertParameterName': "/bench/pki/certs/ca",
+            'KeyParameterName': f"/bench/pki/private/leaf-{i}",
+            'CertParameterName': f"/bench/pki/certs/leaf-{i}",
+            'ReuseKey': args.reuse_key
+        }
+        for i in range(args.count)
+    ]
+    if args.reuse_key:
+        renew(session, certificates, 1)
+
+    key_description = libarkcert.describe_key_type(args.key_type, args.key_size, args.curve)
+    print(f"{args.count} certificates, {key_description}, {os.cpu_count()} CPUs ({platform.processor() or platform.machine()}), Python {platform.python_version()}, cryptography {libarkcert.cryptography.__version__}")
+    dsa_cache_modes = [True]
+    if args.key_type == "DSA":
+        # Save the DSA parameters like a previous invocation would have
+        dsa_cache_modes = [False, True]
+        libarkcert.get_dsa_parameters(args.key_size)
+
+    print(f"{'workers':>7} {'DSA cache':>9} {'seconds':>8} {'certs/s':>8} {'s/cert':>8}")
+    for workers in [int(w) for w in args.workers.split(",")]:
+        for dsa_cache in dsa_cache_modes:
+            if not dsa_cache:
+                del os.environ['DSA_PARAMETERS_PATH']
+            start = time.perf_counter()
+            renew(session, certificates, workers, dsa_cache)
+            elapsed = time.perf_counter() - start
+            os.environ['DSA_PARAMETERS_PATH'] = "/bench/pki/dsa-parameters"
+            dsa_cache_label = ("on" if dsa_cache else "off") if args.key_type == "DSA" else "-"
+            print(f"{workers:>7} {dsa_cache_label:>9} {elapsed:>8.2f} {args.count / elapsed:>8.2f} {elapsed / args.count:>8.3f}")
+
+
+if __name__ == "__main__":
+    main()
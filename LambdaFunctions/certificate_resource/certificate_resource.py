@@ -15,6 +15,11 @@ def handler(event, context):
       - RENEW_CERTIFICATES_STATE_MACHINE_ARN: ARN of the `renew_certificate`
         AWS Step Functions state machine
 
+    The following environment variables are optional:
+      - DSA_PARAMETERS_PATH: SSM path where the DSA domain parameters are
+        saved, so they are generated once per key size rather than for each
+        DSA key
+
     The event received has the following pattern (the fields are mandatory
     unless marked as "optional"):
 
@@ -26,8 +31,10 @@ def handler(event, context):
           "ResourceType": "Custom::Certificate",   # or whatever
           "LogicalResourceId": "Certificate",      # or whatever
           "ResourceProperties": {
-            "KeyType": "RSA",                    # Or "DSA"; optional, defaults to "RSA"
-            "KeySize": 2048,                     # Key size
+            "KeyType": "RSA",                    # Or "DSA", "EC" or "Ed25519"; optional, defaults to "RSA"
+            "KeySize": 2048,                     # Key size; only for "RSA" and "DSA" keys
+            "Curve": "P-256",                    # Or "P-384" or "P-521"; optional, defaults to "P-256";
+                                                 # only for "EC" keys
             "ValidityDays": 100,                 # For how many days the certificate should be valid
 
             "CountryName": "US",                 # Optional
@@ -85,6 +92,16 @@ def handler(event, context):
             "KeyParameterName": "/arkcase/pki/private/my-key",
             # Name of the SSM parameter where to save the certificate
             "CertParameterName": "/arkcase/pki/certs/my-cert",
+            # Name of the SSM parameter where to save the certificate
+            # followed by the certificates of its CAs up to the root;
+            # optional. Must not be under the path of `CertParameterName`.
+            "ChainParameterName": "/arkcase/pki/chains/my-cert",
+
+            # Whether to keep the existing private key when the certificate
+            # is updated, and only re-sign the certificate.
+            #
+            # Optional; default to `false`
+            "ReuseKey": false,
 
             "KeyTags": [  # Tags for the private key SSM parameter, optional
               {
@@ -148,7 +165,8 @@ def upsert_certificate(event, request_type):
 
     # NB: CloudFormation changes all types to "string", so we have to cast all
     #     non-string fields back to their original types.
-    args['KeySize'] = int(args['KeySize'])
+    if 'KeySize' in args:
+        args['KeySize'] = int(args['KeySize'])
     args['ValidityDays'] = int(args['ValidityDays'])
     if 'BasicConstraints' in args:
         bc = args['BasicConstraints']
@@ -171,6 +189,8 @@ def upsert_certificate(event, request_type):
             san['Critical'] = san['Critical'].lower() == "true"
     if 'SelfSigned' in args:
         args['SelfSigned'] = args['SelfSigned'].lower() == "true"
+    if 'ReuseKey' in args:
+        args['ReuseKey'] = args['ReuseKey'].lower() == "true"
 
     # Create/renew the certificate
     # NB: This will also save it in SSM and IAM
@@ -202,6 +222,14 @@ def upsert_certificate(event, request_type):
             iam = boto3.client("iam")
             iam.delete_server_certificate(ServerCertificateName=old_cert_name)
 
+        old_chain_parameter_name = old_args.get('ChainParameterName')
+        if old_chain_parameter_name and args.get('ChainParameterName') != old_chain_parameter_name:
+            print(f"Chain parameter name has changed; deleting old chain parameter {old_chain_parameter_name}")
+            try:
+                ssm.delete_parameter(Name=old_chain_parameter_name)
+            except ssm.exceptions.ParameterNotFound as e:
+                pass
+
     # When a certificate is renewed through the CloudFormation template (eg: a
     # parameter changes, such as `OrganizationalUnitName`) and it is a CA, we
     # need to renew certificates that depend on it as well.
@@ -276,6 +304,14 @@ def delete_certificate(event):
         except ssm.exceptions.ParameterNotFound as e:
             # Already deleted by the previous update
             pass
+    # NB: The chain parameter name is not part of the physical id, so as not
+    #     to change the physical id of existing certificates
+    chain_parameter_name = event.get('ResourceProperties', {}).get('ChainParameterName')
+    if chain_parameter_name:
+        try:
+            ssm.delete_parameter(Name=chain_parameter_name)
+        except ssm.exceptions.ParameterNotFound as e:
+            pass
     if iam_cert_name:
         iam = boto3.client("iam")
         try:
@@ -1,22 +1,72 @@
+import collections
 import datetime
+import json
+import math
+import multiprocessing
+import os
+import posixpath
+import time
+import weakref
 import boto3
 import botocore
 import cryptography
 from cryptography.hazmat.backends import default_backend
 from cryptography.hazmat.primitives import serialization, hashes
-from cryptography.hazmat.primitives.asymmetric import rsa, dsa
+from cryptography.hazmat.primitives.asymmetric import rsa, dsa, ec, ed25519
 from cryptography import x509
 from cryptography.x509.oid import NameOID, ExtensionOID
 
 
-def create_or_renew_cert(args: dict):
+# Tag set on each certificate parameter signed by a CA; its value is the name
+# of the parameter of the CA certificate, which allows to find all the
+# certificates signed by a given CA without scanning all of them.
+#
+# NB: The `check_certificates` Lambda function relies on this tag key.
+ISSUER_TAG_KEY = "IssuerCertParameterName"
+
+# Maximum length of an SSM tag value
+MAX_TAG_VALUE_LENGTH = 256
+
+# Elliptic curves supported by the "EC" key type, and the hash algorithm used
+# to sign with a key on each curve
+EC_CURVES = {
+    "P-256": (ec.SECP256R1, hashes.SHA256),
+    "P-384": (ec.SECP384R1, hashes.SHA384),
+    "P-521": (ec.SECP521R1, hashes.SHA512)
+}
+DEFAULT_EC_CURVE = "P-256"
+
+# Names of the above curves, by their names in `cryptography`
+EC_CURVE_NAMES = {curve.name: name for name, (curve, hash_algorithm) in EC_CURVES.items()}
+
+# DSA domain parameters (p, q, g) by key size; generating them is much
+# slower than generating a key from them, so they are generated once and
+# shared by all the DSA keys of the same size (see `get_dsa_parameters()`)
+dsa_parameters_cache = {}
+
+# CA private keys and certificates loaded by `get_ca_parameters()`, by
+# parameter name; each entry is a tuple `(version, value)`, only valid as
+# long as the parameter is still at that version. The value is the private
+# key, or a tuple `(certificate, chain)` for a certificate.
+CA_CACHE_MAX_ENTRIES = 32
+ca_cache = collections.OrderedDict()
+
+
+# AWS account id of each boto3 session (or of the `boto3` module itself, for
+# the default session), used to build parameter ARNs
+account_ids = weakref.WeakKeyDictionary()
+
+
+def create_or_renew_cert(args: dict, session=None, key=None, timer=None):
     """
     The `args` argument must look like this (fields are mandatory unless marked
     as "optional"):
 
         {
-          "KeyType": "RSA",     # Optional, can be "RSA" or "DSA", default to "RSA"
-          "KeySize": 2048,      # Key size
+          "KeyType": "RSA",     # Optional, can be "RSA", "DSA", "EC" or "Ed25519", default to "RSA"
+          "KeySize": 2048,      # Key size; only for "RSA" and "DSA" keys
+          "Curve": "P-256",     # Optional, can be "P-256", "P-384" or "P-521", default to "P-256";
+                                # only for "EC" keys
           "ValidityDays": 100,  # For how many days the certificate should be valid
 
           "CountryName": "US",                 # Optional
@@ -73,6 +123,19 @@ def create_or_renew_cert(args: dict):
           "KeyParameterName": "/arkcase/pki/private/my-key",
           # Name of the SSM parameter where to save the certificate
           "CertParameterName": "/arkcase/pki/certs/my-cert",
+          # Name of the SSM parameter where to save the certificate chain,
+          # i.e. the PEM-encoded certificate followed by those of its CAs up
+          # to the root; optional. It must not be under the path of
+          # `CertParameterName`, where it would be scanned as a certificate.
+          "ChainParameterName": "/arkcase/pki/chains/my-cert",
+
+          # Whether to keep the private key already saved in
+          # `KeyParameterName` and only re-sign the certificate. A new key is
+          # generated if there is no such key, or if it doesn't match
+          # `KeyType` and `KeySize`.
+          #
+          # Optional; default to `False`
+          "ReuseKey": False,
 
           "KeyTags": [  # Tags for the private key SSM parameter, optional
             {
@@ -96,16 +159,47 @@ def create_or_renew_cert(args: dict):
           ]
         }
 
+    If the certificate is signed by a CA, an `IssuerCertParameterName` tag
+    set to `CaCertParameterName` is added to the certificate parameter.
+
+    The chain saved in `ChainParameterName` is built from the chain of the
+    CA certificate, which is cached along with the CA certificate (see
+    `get_ca_parameters()`), so no CA certificate is fetched for each
+    certificate signed. The chain parameter has the same tags as the
+    certificate parameter, except `IssuerCertParameterName`.
+
+    The certificate is signed with SHA-256 by an RSA or DSA key, with the
+    hash matching the curve of an EC key (SHA-256 for P-256, SHA-384 for
+    P-384 and SHA-512 for P-521), and without a separate hash by an Ed25519
+    key.
+
+    The AWS clients are created from the given boto3 `session`, if any, so
+    the certificate can be saved in another account or region.
+
+    If a private `key` is given (eg: generated in advance by a
+    `KeyGenerator`), it is used instead of generating a new one; it must
+    match `KeyType` and `KeySize` or `Curve`. If `ReuseKey` is set and the existing key
+    can be reused, the given `key` is ignored and the key parameter, including
+    its tags, is left untouched.
+
+    The time spent in each phase (key generation, CA fetch, chain assembly,
+    signing, SSM and IAM uploads, ...) is measured by the given `timer`, if
+    any, or else by a new `PhaseTimer`, and logged as a JSON record once the
+    certificate is saved.
+
     Returns a tuple:
         (key_parameter_arn, cert_parameter_arn, iam_cert_name, iam_cert_arn)
 
-        Please note that `iam_cert_arn` will be an empty string if the
-        certificate is a CA.
+        Please note that `iam_cert_name` and `iam_cert_arn` will be empty
+        strings if the certificate is a CA or has an Ed25519 key, which IAM
+        doesn't support.
     """
     key_type = args.get('KeyType', "RSA")
-    key_size = int(args['KeySize'])
+    key_size = int(args['KeySize']) if 'KeySize' in args else None
+    curve = args.get('Curve', DEFAULT_EC_CURVE) if key_type == "EC" else None
     validity_days = int(args['ValidityDays'])
     self_signed = args.get('SelfSigned', False)
+    reuse_key = args.get('ReuseKey', False)
     if self_signed:
         ca_key_parameter_name = None
         ca_cert_parameter_name = None
@@ -137,6 +231,10 @@ def create_or_renew_cert(args: dict):
         attributes.append(x509.NameAttribute(NameOID.DN_QUALIFIER, value))
         value = "cacert:" + ca_cert_parameter_name
         attributes.append(x509.NameAttribute(NameOID.DN_QUALIFIER, value))
+    chain_parameter_name = args.get('ChainParameterName')
+    if chain_parameter_name:
+        value = "chain:" + chain_parameter_name
+        attributes.append(x509.NameAttribute(NameOID.DN_QUALIFIER, value))
 
     subject = x509.Name(attributes)
 
@@ -212,38 +310,54 @@ def create_or_renew_cert(args: dict):
     cert_parameter_name = args['CertParameterName']
     if "," in cert_parameter_name:
         raise ValueError(f"Certificate parameter name can't have commas: {cert_parameter_name}")
+    if chain_parameter_name:
+        if "," in chain_parameter_name:
+            raise ValueError(f"Chain parameter name can't have commas: {chain_parameter_name}")
+        cert_path = posixpath.dirname(cert_parameter_name).rstrip("/") + "/"
+        if cert_path != "/" and chain_parameter_name.startswith(cert_path):
+            raise ValueError(f"Chain parameter name can't be under the path of the certificate parameter {cert_parameter_name}: {chain_parameter_name}")
     key_tags = args.get('KeyTags', [])
-    cert_tags = args.get('CertTags', [])
+    cert_tags = [tag for tag in args.get('CertTags', []) if tag['Key'] != ISSUER_TAG_KEY]
+    chain_tags = list(cert_tags)
+    if ca_cert_parameter_name:
+        if len(ca_cert_parameter_name) <= MAX_TAG_VALUE_LENGTH:
+            cert_tags.append({'Key': ISSUER_TAG_KEY, 'Value': ca_cert_parameter_name})
+        else:
+            print(f"WARNING: CA certificate parameter name is too long to be saved in the {ISSUER_TAG_KEY} tag: {ca_cert_parameter_name}")
 
-    # Generate private key
+    timer = timer or PhaseTimer()
+    clients = session or boto3
+    ssm = clients.client("ssm")
+    account_id = get_account_id(clients)
+    timer.lap("Setup")
 
-    print(f"Generating private key {key_parameter_name}: {key_type} {key_size} bits")
-    if key_type == "RSA":
-        key = rsa.generate_private_key(
-            public_exponent=65537,
-            key_size=key_size,
-            backend=default_backend()
-        )
-    elif key_type == "DSA":
-        key = dsa.generate_private_key(
-            key_size=key_size,
-            backend=default_backend()
-        )
+    # Reuse the existing private key, or generate a new one
+
+    existing_key = None
+    if reuse_key:
+        existing_key, key_parameter_arn = get_existing_private_key(ssm, key_parameter_name, key_type, key_size, curve)
+    if existing_key:
+        print(f"Reusing existing private key {key_parameter_name}")
+        key = existing_key
+    elif key is None:
+        print(f"Generating private key {key_parameter_name}: {describe_key_type(key_type, key_size, curve)}")
+        key = generate_private_key(key_type, key_size, curve)
+        print(f"Successfully generated private key {key_parameter_name}")
     else:
-        raise ValueError(f"Unsupported key type: {key_type}")
-    print(f"Successfully generated private key {key_parameter_name}")
+        print(f"Using pre-generated private key for {key_parameter_name}")
+    timer.lap("KeyGeneration")
 
     # Get the CA private key and certificate
 
-    ssm = boto3.client("ssm")
     if ca_key_parameter_name:
         # Sign with CA key
-        ca_key, ca_cert = get_ca_parameters(ssm, ca_key_parameter_name, ca_cert_parameter_name)
+        ca_key, ca_cert, ca_chain = get_ca_parameters(ssm, ca_key_parameter_name, ca_cert_parameter_name, timer)
         issuer = ca_cert.subject
     else:
         # Self-signed
         ca_key = None
         ca_cert = None
+        ca_chain = ""
         issuer = subject
 
     # Generate the certificate
@@ -268,28 +382,34 @@ def create_or_renew_cert(args: dict):
 
     if ca_key:
         print(f"Signing certficate {cert_parameter_name} with CA key {ca_key_parameter_name}")
-        cert = cert.sign(ca_key, hashes.SHA256(), default_backend())
+        cert = cert.sign(ca_key, get_signing_hash(ca_key), default_backend())
     else:
         print(f"Self-signing certificate {cert_parameter_name}")
-        cert = cert.sign(key, hashes.SHA256(), default_backend())
+        cert = cert.sign(key, get_signing_hash(key), default_backend())
+    timer.lap("Signing")
 
-    # Save the private key
+    # Save the private key, unless the existing one is reused
 
-    print(f"Saving private key {key_parameter_name} in Parameter Store")
     key_value = key.private_bytes(
         encoding=serialization.Encoding.PEM,
         format=serialization.PrivateFormat.PKCS8,
         encryption_algorithm=serialization.NoEncryption()
     ).decode('utf8')
 
-    key_parameter_arn = upsert_param(
-        ssm,
-        key_parameter_name,
-        key_value,
-        "Private key for " + cert_parameter_name,
-        "SecureString",
-        key_tags
-    )
+    if existing_key:
+        print(f"Private key {key_parameter_name} is reused: not saving it")
+    else:
+        print(f"Saving private key {key_parameter_name} in Parameter Store")
+        key_parameter_arn = upsert_param(
+            ssm,
+            key_parameter_name,
+            key_value,
+            "Private key for " + cert_parameter_name,
+            "SecureString",
+            key_tags,
+            account_id=account_id
+        )
+    timer.lap("KeyUpsert")
 
     # Save the certificate
 
@@ -302,8 +422,26 @@ def create_or_renew_cert(args: dict):
         cert_value,
         "X.509 certificate for " + cert_parameter_name,
         "String",
-        cert_tags
+        cert_tags,
+        account_id=account_id
     )
+    timer.lap("CertUpsert")
+
+    # Save the certificate chain
+
+    if chain_parameter_name:
+        print(f"Saving certificate chain {chain_parameter_name} in Parameter Store")
+        upsert_param(
+            ssm,
+            chain_parameter_name,
+            cert_value + ca_chain,
+            "X.509 certificate chain for " + cert_parameter_name,
+            "String",
+            chain_tags,
+            tier="Intelligent-Tiering",  # Chains may exceed 4KB
+            account_id=account_id
+        )
+        timer.lap("ChainUpsert")
 
     # Save the certificate in IAM, but only if it is not a CA
 
@@ -311,6 +449,10 @@ def create_or_renew_cert(args: dict):
         print(f"Certificate {cert_parameter_name} is a CA: not saving it to IAM")
         iam_cert_name = ""
         iam_cert_arn = ""
+    elif isinstance(key, ed25519.Ed25519PrivateKey):
+        print(f"Certificate {cert_parameter_name} has an Ed25519 key, which IAM doesn't support: not saving it to IAM")
+        iam_cert_name = ""
+        iam_cert_arn = ""
     else:
         print(f"Saving non-CA certificate {cert_parameter_name} in IAM")
         path_items = cert_parameter_name.split("/")
@@ -323,10 +465,9 @@ def create_or_renew_cert(args: dict):
         if not cert_path.endswith("/"):
             cert_path += "/"
 
-        chain = ""
-        chain = chain_certificate(ssm, chain, ca_cert)
+        chain = ca_chain
 
-        iam = boto3.client("iam")
+        iam = clients.client("iam")
         try:
             response = iam.upload_server_certificate(
                 Path=cert_path,
@@ -348,12 +489,292 @@ def create_or_renew_cert(args: dict):
 
         iam_cert_name = cert_name
         iam_cert_arn = response['ServerCertificateMetadata']['Arn']
+        timer.lap("IamUpload")
 
     # Done
     print(f"Successfully generated private key and certificate; key ARN: {key_parameter_arn}, certificate ARN: {cert_parameter_arn}, IAM ARN: {iam_cert_arn}")
+    print(json.dumps(timer.get_record(
+        Type="CertificateTimings",
+        CertParameterName=cert_parameter_name,
+        KeyType=key_type,
+        ReusedKey=existing_key is not None
+    )))
     return key_parameter_arn, cert_parameter_arn, iam_cert_name, iam_cert_arn
 
 
+def generate_private_key(key_type, key_size=None, curve=None):
+    """Generate a private key; `key_size` is required for "RSA" and "DSA"
+    keys, and `curve` is used for "EC" keys
+
+    DSA keys are generated from the domain parameters returned by
+    `get_dsa_parameters()`.
+    """
+    if key_type in ("RSA", "DSA") and key_size is None:
+        raise ValueError(f"A key size is required for {key_type} keys")
+    if key_type == "RSA":
+        return rsa.generate_private_key(
+            public_exponent=65537,
+            key_size=key_size,
+            backend=default_backend()
+        )
+    elif key_type == "DSA":
+        return get_dsa_parameters(key_size).generate_private_key()
+    elif key_type == "EC":
+        curve = curve or DEFAULT_EC_CURVE
+        if curve not in EC_CURVES:
+            raise ValueError(f"Unsupported curve: {curve}")
+        return ec.generate_private_key(
+            curve=EC_CURVES[curve][0](),
+            backend=default_backend()
+        )
+    elif key_type == "Ed25519":
+        return ed25519.Ed25519PrivateKey.generate()
+    else:
+        raise ValueError(f"Unsupported key type: {key_type}")
+
+
+def get_dsa_parameters(key_size):
+    """Get the DSA domain parameters to generate keys of the given size
+
+    The parameters are cached in memory. If the `DSA_PARAMETERS_PATH`
+    environment variable is set, they are also saved in the SSM parameter
+    `<DSA_PARAMETERS_PATH>/<key_size>` of the account and region of the
+    current Lambda function, so they are reused across invocations and by
+    all the Lambda functions using this library; otherwise, new parameters
+    are generated for each process.
+    """
+    if key_size in dsa_parameters_cache:
+        return dsa_parameters_cache[key_size]
+
+    path = os.environ.get('DSA_PARAMETERS_PATH', "")
+    if path:
+        ssm = boto3.client("ssm")
+        name = path.rstrip("/") + f"/{key_size}"
+        parameters = load_dsa_parameters(ssm, name)
+        if parameters is None:
+            print(f"Generating DSA parameters {name}")
+            parameters = dsa.generate_parameters(key_size=key_size, backend=default_backend())
+            numbers = parameters.parameter_numbers()
+            value = json.dumps({'p': f"{numbers.p:x}", 'q': f"{numbers.q:x}", 'g': f"{numbers.g:x}"})
+            try:
+                ssm.put_parameter(
+                    Name=name,
+                    Value=value,
+                    Description=f"DSA parameters for {key_size} bits keys",
+                    Type="String",
+                    Overwrite=False
+                )
+            except ssm.exceptions.ParameterAlreadyExists:
+                # Saved by another process in the meantime: use those
+                # parameters instead, so all the keys share the same ones
+                parameters = load_dsa_parameters(ssm, name)
+    else:
+        print(f"Generating DSA parameters for {key_size} bits keys")
+        parameters = dsa.generate_parameters(key_size=key_size, backend=default_backend())
+
+    dsa_parameters_cache[key_size] = parameters
+    return parameters
+
+
+def load_dsa_parameters(ssm, name):
+    """Load the DSA parameters saved in the given SSM parameter
+
+    Returns `None` if there is no such parameter.
+    """
+    try:
+        response = ssm.get_parameter(Name=name)
+    except ssm.exceptions.ParameterNotFound:
+        return None
+    print(f"Loaded DSA parameters {name}")
+    value = json.loads(response['Parameter']['Value'])
+    numbers = dsa.DSAParameterNumbers(p=int(value['p'], 16), q=int(value['q'], 16), g=int(value['g'], 16))
+    return numbers.parameters(default_backend())
+
+
+def describe_key_type(key_type, key_size=None, curve=None):
+    if key_type == "EC":
+        return f"EC {curve or DEFAULT_EC_CURVE}"
+    elif key_type == "Ed25519":
+        return key_type
+    else:
+        return f"{key_type} {key_size} bits"
+
+
+def key_matches(key, key_type, key_size=None, curve=None):
+    """Check whether the given private key has the given type and size or
+    curve
+    """
+    if key_type == "RSA":
+        return isinstance(key, rsa.RSAPrivateKey) and key.key_size == key_size
+    elif key_type == "DSA":
+        return isinstance(key, dsa.DSAPrivateKey) and key.key_size == key_size
+    elif key_type == "EC":
+        curve = curve or DEFAULT_EC_CURVE
+        return (
+            isinstance(key, ec.EllipticCurvePrivateKey)
+            and curve in EC_CURVES
+            and key.curve.name == EC_CURVES[curve][0].name
+        )
+    elif key_type == "Ed25519":
+        return isinstance(key, ed25519.Ed25519PrivateKey)
+    else:
+        return False
+
+
+def get_signing_hash(signing_key):
+    """Get the hash algorithm to sign certificates with the given private
+    key; `None` for Ed25519 keys, which don't use a separate hash
+    """
+    if isinstance(signing_key, ed25519.Ed25519PrivateKey):
+        return None
+    if isinstance(signing_key, ec.EllipticCurvePrivateKey):
+        for curve_class, hash_class in EC_CURVES.values():
+            if signing_key.curve.name == curve_class.name:
+                return hash_class()
+    return hashes.SHA256()
+
+
+class PhaseTimer:
+    """Measure the time spent in the successive phases of an operation,
+    by calling `lap()` at the end of each phase
+
+    The given `fields` are added to the log records of this timer, eg: to
+    tell which run of a batch they belong to.
+    """
+    def __init__(self, **fields):
+        self.start = self.last = time.perf_counter()
+        self.durations = collections.OrderedDict()  # phase -> seconds
+        self.fields = fields
+
+    def lap(self, phase):
+        """End the current phase, i.e. add the time since the end of the
+        previous phase to the duration of `phase`
+        """
+        now = time.perf_counter()
+        self.durations[phase] = self.durations.get(phase, 0.0) + now - self.last
+        self.last = now
+
+    @property
+    def total(self):
+        return self.last - self.start
+
+    def get_record(self, **fields):
+        """Build a log record of the durations, in milliseconds, with the
+        given extra fields
+        """
+        record = dict(self.fields)
+        record.update(fields)
+        record['TotalMs'] = round(1000 * self.total, 1)
+        record['PhasesMs'] = {phase: round(1000 * seconds, 1) for phase, seconds in self.durations.items()}
+        return record
+
+
+class PhaseStats:
+    """Aggregate the durations measured by several `PhaseTimer` objects"""
+    PERCENTILES = [50, 90, 99]
+
+    def __init__(self):
+        self.durations = collections.OrderedDict()  # phase -> list of seconds
+
+    def add(self, timer):
+        for phase, seconds in timer.durations.items():
+            self.durations.setdefault(phase, []).append(seconds)
+        self.durations.setdefault("Total", []).append(timer.total)
+
+    def get_summary(self):
+        """Get the count, percentiles and maximum of the duration of each
+        phase, in milliseconds
+        """
+        summary = collections.OrderedDict()
+        for phase, durations in self.durations.items():
+            durations = sorted(durations)
+            stats = {'Count': len(durations)}
+            for percentile in self.PERCENTILES:
+                # Nearest-rank percentile
+                rank = max(1, math.ceil(percentile * len(durations) / 100))
+                stats[f"P{percentile}Ms"] = round(1000 * durations[rank - 1], 1)
+            stats['MaxMs'] = round(1000 * durations[-1], 1)
+            summary[phase] = stats
+        return summary
+
+
+class KeyGenerator:
+    """Generate private keys in the background, in up to `workers` child
+    processes, so the CPU time spent generating the keys of the next
+    certificates overlaps with the signing and saving of the current one
+
+    Keys are identified by an arbitrary `index`, eg: the index of the
+    certificate in the list of certificates to renew.
+
+    NB: `concurrent.futures.ProcessPoolExecutor` and `multiprocessing.Pool`
+        don't work in AWS Lambda, which has no `/dev/shm`; so each key is
+        generated in its own process and sent back through a pipe instead.
+    """
+    def __init__(self, workers):
+        self.workers = workers
+        self.pending = {}  # index -> (process, connection)
+
+    def prefetch(self, index, key_type, key_size=None, curve=None):
+        """Start generating a key in the background, unless it's already
+        being generated or all the workers are busy
+        """
+        if self.workers <= 1 or index in self.pending or len(self.pending) >= self.workers:
+            return
+        if key_type == "DSA" and key_size is not None:
+            # Get the DSA parameters once here, so the child processes don't
+            # each have to
+            get_dsa_parameters(key_size)
+        receiver, sender = multiprocessing.Pipe(duplex=False)
+        process = multiprocessing.Process(
+            target=generate_private_key_in_child,
+            args=(sender, key_type, key_size, curve),
+            daemon=True
+        )
+        process.start()
+        sender.close()
+        self.pending[index] = (process, receiver)
+
+    def get(self, index):
+        """Wait for the key generated in the background for `index`
+
+        Returns `None` if the key wasn't prefetched.
+        """
+        if index not in self.pending:
+            return None
+        process, receiver = self.pending.pop(index)
+        try:
+            status, data = receiver.recv()
+        finally:
+            receiver.close()
+            process.join()
+        if status != "ok":
+            raise ValueError(data)
+        return serialization.load_der_private_key(data, password=None, backend=default_backend())
+
+    def close(self):
+        """Stop generating the keys that haven't been collected"""
+        for process, receiver in self.pending.values():
+            process.terminate()
+            process.join()
+            receiver.close()
+        self.pending = {}
+
+
+def generate_private_key_in_child(sender, key_type, key_size, curve):
+    try:
+        key = generate_private_key(key_type, key_size, curve)
+        data = key.private_bytes(
+            encoding=serialization.Encoding.DER,
+            format=serialization.PrivateFormat.PKCS8,
+            encryption_algorithm=serialization.NoEncryption()
+        )
+        sender.send(("ok", data))
+    except Exception as e:
+        sender.send(("error", str(e)))
+    finally:
+        sender.close()
+
+
 def add_attribute_if_present(event, key, attributes, name_oid):
     if key in event:
         attributes.append(
@@ -361,74 +782,256 @@ def add_attribute_if_present(event, key, attributes, name_oid):
         )
 
 
-def get_ca_parameters(ssm, ca_key_parameter_name, ca_cert_parameter_name):
-    """Retrieve the CA private key and certificate"""
-    print(f"Retrieving CA private key")
-    response = ssm.get_parameter(
-        Name=ca_key_parameter_name,
-        WithDecryption=True
-    )
-    ca_key_value = response['Parameter']['Value']
-    ca_key = serialization.load_pem_private_key(
-        ca_key_value.encode('utf8'),
+def get_existing_private_key(ssm, key_parameter_name, key_type, key_size, curve=None):
+    """Retrieve the private key saved in the given parameter, if it matches
+    the given key type and size or curve
+
+    Returns a tuple `(key, key_parameter_arn)`, or `(None, None)` if there is
+    no such key or it can't be reused.
+    """
+    print(f"Retrieving existing private key {key_parameter_name}")
+    try:
+        response = ssm.get_parameter(
+            Name=key_parameter_name,
+            WithDecryption=True
+        )
+    except ssm.exceptions.ParameterNotFound:
+        print(f"Private key {key_parameter_name} doesn't exist; a new one will be generated")
+        return None, None
+    key = serialization.load_pem_private_key(
+        response['Parameter']['Value'].encode('utf8'),
         password=None,
         backend=default_backend()
     )
+    if not key_matches(key, key_type, key_size, curve):
+        print(f"Private key {key_parameter_name} is not a {describe_key_type(key_type, key_size, curve)} key; a new one will be generated")
+        return None, None
+    return key, response['Parameter']['ARN']
 
-    print(f"Retrieving CA certificate")
-    response = ssm.get_parameter(Name=ca_cert_parameter_name)
-    ca_cert_value = response['Parameter']['Value']
-    ca_cert = x509.load_pem_x509_certificate(
-        ca_cert_value.encode('utf8'),
-        backend=default_backend()
+
+def get_ca_parameters(ssm, ca_key_parameter_name, ca_cert_parameter_name, timer=None):
+    """Retrieve the CA private key and certificate, and the chain of the CA
+    certificate (i.e. the PEM-encoded CA certificate followed by those of
+    its own CAs up to the root)
+
+    The loaded key, certificate and chain are kept in memory, and reused as
+    long as their parameters keep the same version: the current versions
+    are fetched on each call (without decrypting the key), and the key is
+    only fetched, decrypted and parsed again if it has changed, eg: because
+    the CA has been renewed since.
+
+    The time spent fetching the CA parameters and building the chain is
+    measured by the given `timer`, if any.
+
+    Returns a tuple `(ca_key, ca_cert, ca_chain)`.
+    """
+    response = ssm.get_parameters(
+        Names=[ca_key_parameter_name, ca_cert_parameter_name],
+        WithDecryption=False
     )
+    if response.get('InvalidParameters'):
+        raise KeyError(f"CA parameters not found: {response['InvalidParameters']}")
+    parameters = {parameter['Name']: parameter for parameter in response['Parameters']}
 
-    return ca_key, ca_cert
+    ca_key = get_cached_ca_parameter(ca_key_parameter_name, parameters[ca_key_parameter_name]['Version'])
+    if ca_key is None:
+        print(f"Retrieving CA private key")
+        response = ssm.get_parameter(
+            Name=ca_key_parameter_name,
+            WithDecryption=True
+        )
+        ca_key_value = response['Parameter']['Value']
+        ca_key = serialization.load_pem_private_key(
+            ca_key_value.encode('utf8'),
+            password=None,
+            backend=default_backend()
+        )
+        cache_ca_parameter(ca_key_parameter_name, response['Parameter']['Version'], ca_key)
+    else:
+        print(f"Using cached CA private key")
+
+    ca_cert_version = parameters[ca_cert_parameter_name]['Version']
+    cached = get_cached_ca_parameter(ca_cert_parameter_name, ca_cert_version)
+    if cached is None:
+        ca_cert_value = parameters[ca_cert_parameter_name]['Value']
+        ca_cert = x509.load_pem_x509_certificate(
+            ca_cert_value.encode('utf8'),
+            backend=default_backend()
+        )
+        if timer:
+            timer.lap("CaFetch")
+        ca_chain = get_chain(ssm, ca_cert)
+        if timer:
+            timer.lap("ChainAssembly")
+        cache_ca_parameter(ca_cert_parameter_name, ca_cert_version, (ca_cert, ca_chain))
+    else:
+        ca_cert, ca_chain = cached
+        if timer:
+            timer.lap("CaFetch")
+
+    return ca_key, ca_cert, ca_chain
+
+
+def get_chain(ssm, cert):
+    """Get the chain of the given certificate from its chain parameter, if
+    it has one and it is up to date, or else by walking up its CAs
+    """
+    cert_value = cert.public_bytes(serialization.Encoding.PEM).decode('utf8')
+    for attribute in cert.subject.get_attributes_for_oid(NameOID.DN_QUALIFIER):
+        tmp = attribute.value.split(":", 1)
+        if tmp[0] == "chain":
+            try:
+                response = ssm.get_parameter(Name=tmp[1])
+                chain = response['Parameter']['Value']
+                if chain.startswith(cert_value):
+                    return chain
+            except ssm.exceptions.ParameterNotFound:
+                pass
+            print(f"WARNING: Chain parameter {tmp[1]} is missing or out of date; rebuilding the chain")
+    return chain_certificate(ssm, "", cert)
 
 
-def upsert_param(ssm, name: str, value: str, desc: str, param_type: str, tags: dict):
+def get_cached_ca_parameter(name, version):
+    """Get the loaded CA key or certificate cached for the given parameter
+    version, or `None`
     """
-    Save the parameter
+    if name not in ca_cache:
+        return None
+    cached_version, value = ca_cache[name]
+    if cached_version != version:
+        del ca_cache[name]
+        return None
+    ca_cache.move_to_end(name)
+    return value
+
+
+def cache_ca_parameter(name, version, value):
+    ca_cache[name] = (version, value)
+    ca_cache.move_to_end(name)
+    while len(ca_cache) > CA_CACHE_MAX_ENTRIES:
+        ca_cache.popitem(last=False)
+
+
+def upsert_param(
+        ssm,
+        name: str,
+        value: str,
+        desc: str,
+        param_type: str,
+        tags: list,
+        tier: str = None,
+        account_id: str = None
+):
+    """
+    Save the parameter, in the given `tier` if any, and set its tags
+
+    Only the tags that changed are removed or added, and the tags of a new
+    parameter are not listed. If the `account_id` is given, the ARN is built
+    rather than read back from SSM.
 
     Returns: The parameter's ARN
     """
     # NB: `put_parameter()` doesn't allow `Overwrite` to be set to `True` and
     #     tags to be set as well.
     print(f"upsert_param: Calling ssm.put_parameter(Name={name})")
-    ssm.put_parameter(
+    kwargs = {'Tier': tier} if tier else {}
+    response = ssm.put_parameter(
         Name=name,
         Value=value,
         Description=desc,
         Type=param_type,
-        Overwrite=True
+        Overwrite=True,
+        **kwargs
     )
+    ca_cache.pop(name, None)
 
-    # Erase all existing tags
-    print(f"upsert_param: Calling ssm.list_tags_for_resource(ResourceId={name})")
-    response = ssm.list_tags_for_resource(
-        ResourceType="Parameter",
-        ResourceId=name
-    )
-    print(f"upsert_param: Calling ssm.remove_tags_from_resource(ResourceId={name})")
-    ssm.remove_tags_from_resource(
-        ResourceType="Parameter",
-        ResourceId=name,
-        TagKeys=[tag['Key'] for tag in response['TagList']]
-    )
+    # Get the existing tags, unless the parameter has just been created
+    if response.get('Version') == 1:
+        existing_tags = {}
+    else:
+        print(f"upsert_param: Calling ssm.list_tags_for_resource(ResourceId={name})")
+        response = ssm.list_tags_for_resource(
+            ResourceType="Parameter",
+            ResourceId=name
+        )
+        existing_tags = {tag['Key']: tag['Value'] for tag in response['TagList']}
+
+    # Remove the tags that are not wanted anymore
+    tag_keys = {tag['Key'] for tag in tags}
+    removed_tag_keys = [key for key in existing_tags if key not in tag_keys]
+    if removed_tag_keys:
+        print(f"upsert_param: Calling ssm.remove_tags_from_resource(ResourceId={name})")
+        ssm.remove_tags_from_resource(
+            ResourceType="Parameter",
+            ResourceId=name,
+            TagKeys=removed_tag_keys
+        )
 
-    # Save new tags
-    if tags:
+    # Add the new tags and those whose value changed
+    added_tags = [tag for tag in tags if existing_tags.get(tag['Key']) != tag['Value']]
+    if added_tags:
         print(f"upsert_param: Calling ssm.add_tags_to_resource(ResourceId={name})")
         ssm.add_tags_to_resource(
             ResourceType="Parameter",
             ResourceId=name,
-            Tags=tags
+            Tags=added_tags
         )
 
     # Return the parameter's ARN
-    response = ssm.get_parameter(Name=name)
-    print(f"upsert_param: Success; ARN: {response['Parameter']['ARN']}")
-    return response['Parameter']['ARN']
+    if account_id:
+        arn = get_parameter_arn(ssm, name, account_id)
+    else:
+        response = ssm.get_parameter(Name=name)
+        arn = response['Parameter']['ARN']
+    print(f"upsert_param: Success; ARN: {arn}")
+    return arn
+
+
+def get_account_id(clients):
+    """Get the AWS account id of the given boto3 session or module, once"""
+    if clients not in account_ids:
+        print(f"Calling sts.get_caller_identity()")
+        account_ids[clients] = clients.client("sts").get_caller_identity()['Account']
+    return account_ids[clients]
+
+
+def make_target_session(target, role_session_name):
+    """Create a boto3 session for the given target (a dict with optional
+    `RoleArn`, `ExternalId` and `Region` keys), assuming its role if any
+
+    Returns `None` for the default target, in which case the default session
+    should be used.
+    """
+    if 'RoleArn' not in target:
+        if 'Region' not in target:
+            return None
+        return boto3.session.Session(region_name=target['Region'])
+
+    kwargs = {
+        'RoleArn': target['RoleArn'],
+        'RoleSessionName': role_session_name
+    }
+    if 'ExternalId' in target:
+        kwargs['ExternalId'] = target['ExternalId']
+    sts = boto3.client("sts", region_name=target.get('Region'))
+    credentials = sts.assume_role(**kwargs)['Credentials']
+    return boto3.session.Session(
+        aws_access_key_id=credentials['AccessKeyId'],
+        aws_secret_access_key=credentials['SecretAccessKey'],
+        aws_session_token=credentials['SessionToken'],
+        region_name=target.get('Region')
+    )
+
+
+def get_parameter_arn(ssm, name, account_id):
+    """Build the ARN of an SSM parameter in the account and region of the
+    given SSM client
+    """
+    partition = getattr(ssm.meta, 'partition', "aws")
+    region = ssm.meta.region_name
+    if not name.startswith("/"):
+        name = "/" + name
+    return f"arn:{partition}:ssm:{region}:{account_id}:parameter{name}"
 
 
 def chain_certificate(ssm, chain, cert):
@@ -437,7 +1040,9 @@ def chain_certificate(ssm, chain, cert):
     if cert.subject == cert.issuer:
         return chain  # This certificate is self-signed => end of the chain
 
-    attributes = cert.issuer.get_attributes_for_oid(NameOID.DN_QUALIFIER)
+    # NB: The `cacert` attribute of the subject of this certificate points to
+    #     the parameter of the certificate of its CA
+    attributes = cert.subject.get_attributes_for_oid(NameOID.DN_QUALIFIER)
     for attribute in attributes:
         tmp = attribute.value.split(":", 1)
         if tmp[0] == "cacert":
@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+
+# Count the AWS API calls made by `create_or_renew_cert()` and check the
+# certificate chains it saves, using stubbed boto3 clients (no AWS account
+# is needed)
+
+import boto3
+from botocore.stub import Stubber, ANY
+
+import libarkcert
+
+ACCOUNT_ID = "123456789012"
+ARN_PREFIX = f"arn:aws:ssm:us-east-1:{ACCOUNT_ID}:parameter"
+
+
+class StubbedSession:
+    """boto3 session whose clients are stubbed, and which records the API
+    calls made and the parameters saved
+    """
+    def __init__(self):
+        session = boto3.session.Session(
+            aws_access_key_id="testing",
+            aws_secret_access_key="testing",
+            region_name="us-east-1"
+        )
+        self.clients = {}
+        self.stubbers = {}
+        self.calls = []
+        self.saved_values = {}
+        for service in ["ssm", "iam", "sts"]:
+            client = session.client(service)
+            client.meta.events.register("provide-client-params.*.*", self.record_call)
+            self.clients[service] = client
+            self.stubbers[service] = Stubber(client)
+            self.stubbers[service].activate()
+
+    def client(self, service):
+        return self.clients[service]
+
+    def record_call(self, params, model, **kwargs):
+        self.calls.append(model.name)
+        if model.name == "PutParameter":
+            self.saved_values[params['Name']] = params['Value']
+
+    def stub(self, service, method, response, expected_params=None):
+        self.stubbers[service].add_response(method, response, expected_params)
+
+    def check(self):
+        for stubber in self.stubbers.values():
+            stubber.assert_no_pending_responses()
+        calls = self.calls
+        self.calls = []
+        return calls
+
+
+def tags_params(name, key, value):
+    return {'ResourceType': "Parameter", 'ResourceId': name, key: value}
+
+
+libarkcert.print = lambda *args, **kwargs: None
+session = StubbedSession()
+
+# Issue a new self-signed CA: no tags to list, and the ARNs are built
+# rather than read back
+
+ca = {
+    'KeyType': "EC",
+    'ValidityDays': 365,
+    'CommonName': "Test CA",
+    'SelfSigned': True,
+    'BasicConstraints': {'CA': True},
+    'KeyParameterName': "/test/pki/private/ca",
+    'CertParameterName': "/test/pki/certs/ca",
+    'KeyTags': [{'Key': "Env", 'Value': "test"}],
+    'CertTags': [{'Key': "Env", 'Value': "test"}]
+}
+session.stub("sts", "get_caller_identity", {'Account': ACCOUNT_ID, 'Arn': "arn:aws:iam::123456789012:user/test", 'UserId': "AIDATESTTESTTEST"})
+session.stub("ssm", "put_parameter", {'Version': 1})
+session.stub("ssm", "add_tags_to_resource", {}, tags_params("/test/pki/private/ca", 'Tags', ca['KeyTags']))
+session.stub("ssm", "put_parameter", {'Version': 1})
+session.stub("ssm", "add_tags_to_resource", {}, tags_params("/test/pki/certs/ca", 'Tags', ca['CertTags']))
+key_arn, cert_arn, iam_cert_name, iam_cert_arn = libarkcert.create_or_renew_cert(dict(ca), session)
+assert key_arn == ARN_PREFIX + "/test/pki/private/ca"
+assert cert_arn == ARN_PREFIX + "/test/pki/certs/ca"
+assert iam_cert_name == ""
+calls = session.check()
+assert calls == ["GetCallerIdentity", "PutParameter", "AddTagsToResource", "PutParameter", "AddTagsToResource"]
+print(f"New CA: {len(calls)} API calls")
+
+# Renew a leaf whose tags didn't change: no tag changes, and the account id
+# is not fetched again
+
+
+def stub_ca_parameters(session):
+    session.stub("ssm", "get_parameters", {
+        'Parameters': [
+            {'Name': "/test/pki/private/ca", 'Type': "SecureString", 'Value': "encrypted", 'Version': 1},
+            {'Name': "/test/pki/certs/ca", 'Type': "String", 'Value': session.saved_values["/test/pki/certs/ca"], 'Version': 1}
+        ]
+    })
+
+
+leaf = {
+    'KeyType': "EC",
+    'ValidityDays': 90,
+    'CommonName': "leaf.test.internal",
+    'CaKeyParameterName': "/test/pki/private/ca",
+    'CaCertParameterName': "/test/pki/certs/ca",
+    'KeyParameterName': "/test/pki/private/leaf",
+    'CertParameterName': "/test/pki/certs/leaf",
+    'KeyTags': [{'Key': "A", 'Value': "1"}, {'Key': "B", 'Value': "2"}]
+}
+issuer_tag = {'Key': libarkcert.ISSUER_TAG_KEY, 'Value': "/test/pki/certs/ca"}
+iam_response = {
+    'ServerCertificateMetadata': {
+        'Path': "/test/pki/certs/",
+        'ServerCertificateName': "leaf",
+        'ServerCertificateId': "ASCATESTTESTTEST",
+        'Arn': f"arn:aws:iam::{ACCOUNT_ID}:server-certificate/test/pki/certs/leaf"
+    }
+}
+stub_ca_parameters(session)
+session.stub("ssm", "get_parameter", {'Parameter': {'Name': "/test/pki/private/ca", 'Type': "SecureString", 'Value': session.saved_values["/test/pki/private/ca"], 'Version': 1}})
+session.stub("ssm", "put_parameter", {'Version': 2})
+session.stub("ssm", "list_tags_for_resource", {'TagList': leaf['KeyTags']})
+session.stub("ssm", "put_parameter", {'Version': 2})
+session.stub("ssm", "list_tags_for_resource", {'TagList': [issuer_tag]})
+session.stub("iam", "upload_server_certificate", iam_response, {
+    'Path': "/test/pki/certs/",
+    'ServerCertificateName': "leaf",
+    'CertificateBody': ANY,
+    'PrivateKey': ANY,
+    'CertificateChain': session.saved_values["/test/pki/certs/ca"]
+})
+key_arn, cert_arn, iam_cert_name, iam_cert_arn = libarkcert.create_or_renew_cert(dict(leaf), session)
+assert key_arn == ARN_PREFIX + "/test/pki/private/leaf"
+assert cert_arn == ARN_PREFIX + "/test/pki/certs/leaf"
+assert iam_cert_arn == iam_response['ServerCertificateMetadata']['Arn']
+calls = session.check()
+assert calls == [
+    "GetParameters", "GetParameter",
+    "PutParameter", "ListTagsForResource",
+    "PutParameter", "ListTagsForResource",
+    "UploadServerCertificate"
+]
+print(f"Leaf renewal, unchanged tags: {len(calls)} API calls")
+
+# Renew the leaf again with changed tags: only the differences are saved,
+# and the CA private key is not fetched again
+
+leaf['KeyTags'] = [{'Key': "A", 'Value': "1"}, {'Key': "B", 'Value': "3"}]
+stub_ca_parameters(session)
+session.stub("ssm", "put_parameter", {'Version': 3})
+session.stub("ssm", "list_tags_for_resource", {'TagList': [{'Key': "A", 'Value': "1"}, {'Key': "B", 'Value': "2"}, {'Key': "Old", 'Value': "x"}]})
+session.stub("ssm", "remove_tags_from_resource", {}, tags_params("/test/pki/private/leaf", 'TagKeys', ["Old"]))
+session.stub("ssm", "add_tags_to_resource", {}, tags_params("/test/pki/private/leaf", 'Tags', [{'Key': "B", 'Value': "3"}]))
+session.stub("ssm", "put_parameter", {'Version': 3})
+session.stub("ssm", "list_tags_for_resource", {'TagList': [issuer_tag]})
+session.stub("iam", "upload_server_certificate", iam_response)
+libarkcert.create_or_renew_cert(dict(leaf), session)
+calls = session.check()
+assert calls == [
+    "GetParameters",
+    "PutParameter", "ListTagsForResource", "RemoveTagsFromResource", "AddTagsToResource",
+    "PutParameter", "ListTagsForResource",
+    "UploadServerCertificate"
+]
+print(f"Leaf renewal, changed tags, cached CA: {len(calls)} API calls")
+
+# Issue an intermediate CA with its chain, then a leaf signed by it: the
+# leaf's chain is read from the chain parameter of the intermediate CA, and
+# IAM gets the intermediate and root certificates
+
+inter = {
+    'KeyType': "EC",
+    'ValidityDays': 180,
+    'CommonName': "Test Intermediate CA",
+    'BasicConstraints': {'CA': True},
+    'CaKeyParameterName': "/test/pki/private/ca",
+    'CaCertParameterName': "/test/pki/certs/ca",
+    'KeyParameterName': "/test/pki/private/inter",
+    'CertParameterName': "/test/pki/certs/inter",
+    'ChainParameterName': "/test/pki/chains/inter"
+}
+stub_ca_parameters(session)
+session.stub("ssm", "put_parameter", {'Version': 1})
+session.stub("ssm", "put_parameter", {'Version': 1})
+session.stub("ssm", "add_tags_to_resource", {}, tags_params("/test/pki/certs/inter", 'Tags', [issuer_tag]))
+session.stub("ssm", "put_parameter", {'Version': 1})
+libarkcert.create_or_renew_cert(dict(inter), session)
+calls = session.check()
+assert calls == ["GetParameters", "PutParameter", "PutParameter", "AddTagsToResource", "PutParameter"]
+root_value = session.saved_values["/test/pki/certs/ca"]
+inter_value = session.saved_values["/test/pki/certs/inter"]
+assert session.saved_values["/test/pki/chains/inter"] == inter_value + root_value
+print(f"New intermediate CA with chain: {len(calls)} API calls")
+
+leaf2 = {
+    'KeyType': "EC",
+    'ValidityDays': 90,
+    'CommonName': "leaf2.test.internal",
+    'CaKeyParameterName': "/test/pki/private/inter",
+    'CaCertParameterName': "/test/pki/certs/inter",
+    'KeyParameterName': "/test/pki/private/leaf2",
+    'CertParameterName': "/test/pki/certs/leaf2",
+    'ChainParameterName': "/test/pki/chains/leaf2"
+}
+session.stub("ssm", "get_parameters", {
+    'Parameters': [
+        {'Name': "/test/pki/private/inter", 'Type': "SecureString", 'Value': "encrypted", 'Version': 1},
+        {'Name': "/test/pki/certs/inter", 'Type': "String", 'Value': inter_value, 'Version': 1}
+    ]
+})
+session.stub("ssm", "get_parameter", {'Parameter': {'Name': "/test/pki/private/inter", 'Type': "SecureString", 'Value': session.saved_values["/test/pki/private/inter"], 'Version': 1}})
+session.stub("ssm", "get_parameter", {'Parameter': {'Name': "/test/pki/chains/inter", 'Type': "String", 'Value': inter_value + root_value, 'Version': 1}}, {'Name': "/test/pki/chains/inter"})
+session.stub("ssm", "put_parameter", {'Version': 1})
+session.stub("ssm", "put_parameter", {'Version': 1})
+session.stub("ssm", "add_tags_to_resource", {}, tags_params("/test/pki/certs/leaf2", 'Tags', [{'Key': libarkcert.ISSUER_TAG_KEY, 'Value': "/test/pki/certs/inter"}]))
+session.stub("ssm", "put_parameter", {'Version': 1})
+session.stub("iam", "upload_server_certificate", iam_response, {
+    'Path': "/test/pki/certs/",
+    'ServerCertificateName': "leaf2",
+    'CertificateBody': ANY,
+    'PrivateKey': ANY,
+    'CertificateChain': inter_value + root_value
+})
+libarkcert.create_or_renew_cert(dict(leaf2), session)
+calls = session.check()
+assert calls == [
+    "GetParameters", "GetParameter", "GetParameter",
+    "PutParameter",
+    "PutParameter", "AddTagsToResource",
+    "PutParameter",
+    "UploadServerCertificate"
+]
+leaf2_value = session.saved_values["/test/pki/certs/leaf2"]
+assert session.saved_values["/test/pki/chains/leaf2"] == leaf2_value + inter_value + root_value
+print(f"New leaf with chain, signed by the intermediate CA: {len(calls)} API calls")
+
+# A chain parameter under the path of the certificate parameter is rejected
+# before any API call
+
+try:
+    libarkcert.create_or_renew_cert(dict(leaf2, ChainParameterName="/test/pki/certs/chains/leaf2"), session)
+    assert False, "ValueError not raised"
+except ValueError:
+    pass
+assert session.check() == []
+
+print("All tests OK")
@@ -0,0 +1,476 @@
+#!/usr/bin/env python3
+
+# Benchmark of the `check_certificates` Lambda function
+#
+# This generates synthetic PKI forests and runs `handle_request()` against
+# in-process stand-ins for SSM and S3, so no AWS account is needed. For each
+# size and mode of operation, it reports the wall time, the peak memory
+# allocated by Python while handling the request, the increase of the peak
+# resident set size (which includes the memory allocated by `cryptography`
+# outside of Python; Linux only) and the number of calls made to each AWS
+# API.
+#
+# With `--baseline-records`, each case is run a second time with the
+# certificate records the Lambda function used to keep (instances with a
+# `__dict__`, holding the parsed X.509 certificate), and their peak memory
+# and RSS increase are reported next to those of the compact records.
+#
+# Examples:
+#
+#     ./bench.py
+#     ./bench.py --sizes 1000 --width 4 --depth 3 --due-fraction 0.2
+#     ./bench.py --sizes 50000 --modes renewal,incremental
+#     ./bench.py --sizes 1000,10000,50000 --modes renewal --baseline-records
+#
+# NB: This requires the `boto3` and `cryptography` packages, and a platform
+#     where processes can be forked (each case runs in its own process).
+
+import argparse
+import datetime
+import gc
+import io
+import json
+import multiprocessing
+import os
+import random
+import sys
+import threading
+import time
+import tracemalloc
+
+import botocore.exceptions
+from cryptography import x509
+from cryptography.x509.oid import NameOID
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+
+# `libarkcert` is packaged with the Lambda function (see `custom-package.sh`)
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "certificate_resource"))
+import check_certificates
+
+PKI_PATH = "/bench/pki"
+BUCKET = "bench"
+MODES = ["renewal", "incremental", "cascade", "cascade-tags"]
+
+
+class FakeClient:
+    """Base class for the in-process AWS clients; counts the API calls"""
+
+    def __init__(self):
+        self.calls = {}
+        self.lock = threading.Lock()
+
+    def count(self, api):
+        with self.lock:
+            self.calls[api] = self.calls.get(api, 0) + 1
+
+
+class FakeSSM(FakeClient):
+    """Minimal in-memory SSM Parameter Store"""
+
+    def __init__(self):
+        super().__init__()
+        self.parameters = {}
+        self.tags = {}
+        self.names_by_path = {}
+        self.names_by_tag = {}
+
+    def add(self, name, value, type="String", tags=None):
+        self.parameters[name] = {
+            'Name': name,
+            'Type': type,
+            'Value': value,
+            'Version': 1,
+            'ARN': f"arn:aws:ssm:us-east-1:123456789012:parameter{name}"
+        }
+        self.tags[name] = tags or []
+        self.names_by_path = {}
+        self.names_by_tag = {}
+
+    def names_under(self, path):
+        # NB: Cached, as the callers page through the same listing
+        if path not in self.names_by_path:
+            prefix = path.rstrip("/") + "/"
+            self.names_by_path[path] = sorted(n for n in self.parameters if n.startswith(prefix))
+        return self.names_by_path[path]
+
+    def names_tagged(self, key, values):
+        if key not in self.names_by_tag:
+            index = {}
+            for name in sorted(self.parameters):
+                for tag in self.tags[name]:
+                    if tag['Key'] == key:
+                        index.setdefault(tag['Value'], []).append(name)
+            self.names_by_tag[key] = index
+        names = set()
+        for value in values:
+            names.update(self.names_by_tag[key].get(value, []))
+        return names
+
+    def get_page(self, names, max_results, next_token, metadata_only=False):
+        start = int(next_token or 0)
+        parameters = []
+        for name in names[start:start + max_results]:
+            parameter = dict(self.parameters[name])
+            if metadata_only:
+                del parameter['Value']
+            parameters.append(parameter)
+        response = {'Parameters': parameters}
+        if start + max_results < len(names):
+            response['NextToken'] = str(start + max_results)
+        return response
+
+    def get_parameters_by_path(self, Path, Recursive=False, WithDecryption=False, MaxResults=10, NextToken=""):
+        self.count("get_parameters_by_path")
+        return self.get_page(self.names_under(Path), MaxResults, NextToken)
+
+    def describe_parameters(self, ParameterFilters=(), MaxResults=50, NextToken=""):
+        self.count("describe_parameters")
+        names = None
+        for f in ParameterFilters:
+            if f['Key'] == "Path":
+                names = [n for path in f['Values'] for n in self.names_under(path)]
+            elif f['Key'].startswith("tag:"):
+                tagged = self.names_tagged(f['Key'][len("tag:"):], f['Values'])
+                candidates = names if names is not None else self.names_under("/")
+                names = [n for n in candidates if n in tagged]
+        if names is None:
+            names = self.names_under("/")
+        return self.get_page(names, MaxResults, NextToken, metadata_only=True)
+
+    def get_parameters(self, Names, WithDecryption=False):
+        self.count("get_parameters")
+        assert len(Names) <= 10
+        return {
+            'Parameters': [dict(self.parameters[n]) for n in Names if n in self.parameters],
+            'InvalidParameters': [n for n in Names if n not in self.parameters]
+        }
+
+    def list_tags_for_resource(self, ResourceType, ResourceId):
+        self.count("list_tags_for_resource")
+        return {'TagList': list(self.tags[ResourceId])}
+
+
+class FakeS3(FakeClient):
+    """Minimal in-memory S3 bucket"""
+
+    def __init__(self):
+        super().__init__()
+        self.objects = {}
+        self.uploads = {}
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        self.count("put_object")
+        self.objects[Key] = Body.encode() if isinstance(Body, str) else bytes(Body)
+        return {}
+
+    def get_object(self, Bucket, Key, **kwargs):
+        self.count("get_object")
+        if Key not in self.objects:
+            error = {'Error': {'Code': "NoSuchKey", 'Message': Key}}
+            raise botocore.exceptions.ClientError(error, "GetObject")
+        return {'Body': io.BytesIO(self.objects[Key])}
+
+    def create_multipart_upload(self, Bucket, Key, **kwargs):
+        self.count("create_multipart_upload")
+        upload_id = str(len(self.uploads))
+        self.uploads[upload_id] = {}
+        return {'UploadId': upload_id}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body):
+        self.count("upload_part")
+        self.uploads[UploadId][PartNumber] = bytes(Body)
+        return {'ETag': f'"{PartNumber}"'}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        self.count("complete_multipart_upload")
+        parts = self.uploads.pop(UploadId)
+        self.objects[Key] = b"".join(parts[p['PartNumber']] for p in MultipartUpload['Parts'])
+        return {}
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        self.count("abort_multipart_upload")
+        self.uploads.pop(UploadId, None)
+        return {}
+
+
+def generate_pki(ssm, size, width, depth, due_fraction, due_days, max_days, seed):
+    """Store a synthetic PKI of `size` certificates in `ssm`
+
+    The PKI is a single root CA with `depth` levels of intermediate CAs
+    below it, each CA having `width` intermediate CAs as children. The
+    remaining certificates are leaves spread evenly over the CAs of the
+    deepest level. A fraction `due_fraction` of the certificates expire in
+    less than `due_days` days, the others expire uniformly between
+    `due_days` and `max_days` days.
+
+    Returns the name of the parameter of the root CA certificate and the
+    list of the names of the parameters of the first-level intermediate CA
+    certificates.
+    """
+    rng = random.Random(seed)
+    # NB: All the certificates share the same small key, as we are only
+    #     interested in the cost of handling them, not of generating them
+    key = rsa.generate_private_key(public_exponent=65537, key_size=1024)
+    key_pem = key.private_bytes(
+        serialization.Encoding.PEM,
+        serialization.PrivateFormat.PKCS8,
+        serialization.NoEncryption()
+    ).decode()
+    now = datetime.datetime.utcnow()
+
+    def add(name, is_ca, issuer):
+        if rng.random() < due_fraction:
+            days = rng.uniform(0, due_days)
+        else:
+            days = rng.uniform(due_days, max_days)
+        key_parameter_name = f"{PKI_PATH}/private/{name}"
+        cert_parameter_name = f"{PKI_PATH}/certs/{name}"
+        attributes = [
+            x509.NameAttribute(NameOID.COMMON_NAME, name),
+            x509.NameAttribute(NameOID.DN_QUALIFIER, "key:" + key_parameter_name)
+        ]
+        tags = [{'Key': "Name", 'Value': name}]
+        if issuer:
+            attributes.append(x509.NameAttribute(NameOID.DN_QUALIFIER, "cakey:" + issuer[1]))
+            attributes.append(x509.NameAttribute(NameOID.DN_QUALIFIER, "cacert:" + issuer[2]))
+            tags.append({'Key': check_certificates.ISSUER_TAG_KEY, 'Value': issuer[2]})
+        subject = x509.Name(attributes)
+        cert = x509.CertificateBuilder() \
+            .subject_name(subject) \
+            .issuer_name(issuer[0] if issuer else subject) \
+            .public_key(key.public_key()) \
+            .serial_number(x509.random_serial_number()) \
+            .not_valid_before(now - datetime.timedelta(days=1)) \
+            .not_valid_after(now + datetime.timedelta(days=days)) \
+            .add_extension(x509.BasicConstraints(ca=is_ca, path_length=None), critical=True) \
+            .sign(key, hashes.SHA256())
+        cert_pem = cert.public_bytes(serialization.Encoding.PEM).decode()
+        ssm.add(key_parameter_name, key_pem, "SecureString", tags)
+        ssm.add(cert_parameter_name, cert_pem, "String", tags)
+        return (subject, key_parameter_name, cert_parameter_name)
+
+    root = add("root", True, None)
+    count = 1
+    levels = [[root]]
+    for level in range(depth):
+        cas = []
+        for parent in levels[-1]:
+            for i in range(width):
+                if count >= size:
+                    break
+                cas.append(add(f"ca{level + 1}-{len(cas)}", True, parent))
+                count += 1
+        if not cas:
+            break
+        levels.append(cas)
+
+    leaf_issuers = levels[-1]
+    for i in range(size - count):
+        add(f"leaf-{i}", False, leaf_issuers[i % len(leaf_issuers)])
+
+    first_level = [ca[2] for ca in levels[1]] if len(levels) > 1 else []
+    return root[2], first_level
+
+
+class BaselineCertificate(check_certificates.Certificate):
+    """Certificate record as kept before the compact records: an instance
+    `__dict__` (no `__slots__`) and the parsed X.509 certificate in `cert`
+    """
+
+
+make_compact_certificate_from_parameter = check_certificates.make_certificate_from_parameter
+
+
+def make_baseline_certificate_from_parameter(parameter):
+    certificate = make_compact_certificate_from_parameter(parameter)
+    baseline = BaselineCertificate.__new__(BaselineCertificate)
+    for name in check_certificates.Certificate.__slots__:
+        setattr(baseline, name, getattr(certificate, name))
+    baseline.cert = check_certificates.load_certificate(parameter['Value'])
+    return baseline
+
+
+def use_baseline_records(enabled):
+    """Make `check_certificates` keep baseline or compact certificate records"""
+    if enabled:
+        check_certificates.make_certificate_from_parameter = make_baseline_certificate_from_parameter
+    else:
+        check_certificates.make_certificate_from_parameter = make_compact_certificate_from_parameter
+
+
+def format_mib(size):
+    return f"{size / 2**20:.1f}" if size is not None else "-"
+
+
+def get_memory_status(field):
+    """Get a memory field of `/proc/self/status` (eg: "VmRSS"), in bytes, or
+    `None` if there is no such file
+    """
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith(field + ":"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def reset_peak_rss():
+    """Reset the peak resident set size of this process to its current
+    resident set size; return whether it could be done
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def run_case(ssm_data, mode, cascade_parameter_name):
+    """Run `handle_request()` once against fresh clients sharing `ssm_data`
+
+    Returns the response, the wall time, the peak memory, the increase of
+    the peak RSS (`None` if it can't be measured) and the API calls.
+    """
+    ssm = FakeSSM()
+    ssm.parameters, ssm.tags = ssm_data
+    s3 = FakeS3()
+    clients = {'ssm': ssm, 's3': s3}
+    check_certificates.boto3.client = lambda service, **kwargs: clients[service]
+
+    os.environ['CASCADE_DISCOVERY'] = "tags" if mode == "cascade-tags" else "scan"
+    event = {'FullRescan': True}
+    if mode.startswith("cascade"):
+        event = {'ParentCertParameterArn': ssm.parameters[cascade_parameter_name]['ARN']}
+    if mode == "incremental":
+        # Build the scan manifest first, so the measured run only has to
+        # check for changes
+        check_certificates.handle_request({'FullRescan': True})
+        ssm.calls.clear()
+        s3.calls.clear()
+        event = {}
+
+    # NB: The timed and the traced runs are separate, as tracing all
+    #     allocations slows down the code noticeably
+    gc.collect()
+    rss = get_memory_status("VmRSS") if reset_peak_rss() else None
+    start = time.perf_counter()
+    response = check_certificates.handle_request(event)
+    elapsed = time.perf_counter() - start
+    if rss is not None:
+        rss = max(0, get_memory_status("VmHWM") - rss)
+    calls = {}
+    for client in clients.values():
+        calls.update(client.calls)
+        client.calls.clear()
+
+    gc.collect()
+    tracemalloc.start()
+    check_certificates.handle_request(event)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return response, elapsed, peak, rss, calls
+
+
+def run_case_in_child(baseline, *args):
+    """Run `run_case()` with baseline or compact certificate records in a
+    child process forked from this one, so that all the cases start from
+    the same memory state, and return its result
+
+    NB: Otherwise, a case could reuse the memory freed by the previous ones,
+        which would hide part of its RSS increase.
+    """
+    context = multiprocessing.get_context("fork")
+    receiver, sender = context.Pipe(duplex=False)
+    process = context.Process(target=send_case_result, args=(sender, baseline) + args)
+    process.start()
+    sender.close()
+    try:
+        return receiver.recv()
+    except EOFError:
+        raise RuntimeError(f"Benchmark process failed with exit code {process.exitcode}") from None
+    finally:
+        process.join()
+
+
+def send_case_result(sender, baseline, *args):
+    use_baseline_records(baseline)
+    sender.send(run_case(*args))
+    sender.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the check_certificates Lambda function")
+    parser.add_argument("--sizes", default="100,1000,10000,50000",
+                        help="Comma-separated numbers of certificates (default: %(default)s)")
+    parser.add_argument("--modes", default=",".join(MODES),
+                        help="Comma-separated modes to run among " + ", ".join(MODES) + " (default: all)")
+    parser.add_argument("--width", type=int, default=10,
+                        help="Number of intermediate CAs under each CA (default: %(default)s)")
+    parser.add_argument("--depth", type=int, default=1,
+                        help="Number of levels of intermediate CAs (default: %(default)s)")
+    parser.add_argument("--due-fraction", type=float, default=0.05,
+                        help="Fraction of the certificates due for renewal (default: %(default)s)")
+    parser.add_argument("--days", type=int, default=15,
+                        help="HOW_MANY_DAYS_LEFT_BEFORE_RENEWING (default: %(default)s)")
+    parser.add_argument("--max-days", type=int, default=730,
+                        help="Maximum validity left on a certificate, in days (default: %(default)s)")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed (default: %(default)s)")
+    parser.add_argument("--baseline-records", action="store_true",
+                        help="Also measure the memory used with the baseline certificate records")
+    parser.add_argument("--json", action="store_true", help="Print the results as JSON lines")
+    args = parser.parse_args()
+
+    os.environ['CERT_PARAMETERS_PATHS'] = f"{PKI_PATH}/certs"
+    os.environ['HOW_MANY_DAYS_LEFT_BEFORE_RENEWING'] = str(args.days)
+    os.environ['S3_BUCKET'] = BUCKET
+    # Keep `handle_request()` quiet, except for the results
+    check_certificates.print = lambda *a, **kw: None
+
+    modes = args.modes.split(",")
+    for mode in modes:
+        if mode not in MODES:
+            parser.error(f"Unknown mode: {mode}")
+
+    if not args.json:
+        baseline_header = f" {'base peak':>9} {'base RSS':>8}" if args.baseline_records else ""
+        print(f"{'size':>7} {'mode':<13} {'listed':>7} {'seconds':>8} {'peak MiB':>9} {'RSS MiB':>8}{baseline_header}  API calls")
+    for size in [int(s) for s in args.sizes.split(",")]:
+        ssm = FakeSSM()
+        root, first_level = generate_pki(
+            ssm, size, args.width, args.depth, args.due_fraction, args.days, args.max_days, args.seed
+        )
+        cascade_parameter_name = first_level[0] if first_level else root
+        for mode in modes:
+            ssm_data = (ssm.parameters, ssm.tags)
+            response, elapsed, peak, rss, calls = run_case_in_child(False, ssm_data, mode, cascade_parameter_name)
+            baseline_peak = baseline_rss = None
+            if args.baseline_records:
+                _, _, baseline_peak, baseline_rss, _ = run_case_in_child(True, ssm_data, mode, cascade_parameter_name)
+            if args.json:
+                result = {
+                    'Size': size,
+                    'Mode': mode,
+                    'Count': response['Count'],
+                    'Seconds': round(elapsed, 3),
+                    'PeakBytes': peak,
+                    'PeakRssIncreaseBytes': rss,
+                    'Calls': calls
+                }
+                if args.baseline_records:
+                    result['BaselinePeakBytes'] = baseline_peak
+                    result['BaselinePeakRssIncreaseBytes'] = baseline_rss
+                print(json.dumps(result))
+            else:
+                calls_text = " ".join(f"{api}={n}" for api, n in sorted(calls.items()))
+                baseline_text = ""
+                if args.baseline_records:
+                    baseline_text = f" {format_mib(baseline_peak):>9} {format_mib(baseline_rss):>8}"
+                print(f"{size:>7} {mode:<13} {response['Count']:>7} {elapsed:>8.2f} {format_mib(peak):>9} {format_mib(rss):>8}{baseline_text}  {calls_text}")
+
+
+if __name__ == "__main__":
+    main()
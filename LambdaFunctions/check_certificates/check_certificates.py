@@ -1,24 +1,65 @@
 #!/usr/bin/env python3
 
 import os
-from anytree import NodeMixin, RenderTree, LevelOrderIter
 import boto3
 import botocore
+import botocore.config
 import cryptography
 from cryptography.hazmat.backends import default_backend
 from cryptography.hazmat.primitives import serialization
-from cryptography.hazmat.primitives.asymmetric import rsa, dsa
+from cryptography.hazmat.primitives.asymmetric import rsa, dsa, ec, ed25519
 from cryptography import x509
 from cryptography.x509.oid import NameOID, ExtensionOID
+import bisect
+import collections
+import concurrent.futures
 import datetime
+import gzip
+import hashlib
+import io
 import json
+import posixpath
+import time
+from libarkcert import EC_CURVE_NAMES, ISSUER_TAG_KEY, make_target_session
+
+
+# NB: AWS API doesn't allow to get more than 10 parameters at a time
+SSM_GET_PARAMETERS_MAX = 10
+
+DEFAULT_MAX_CONCURRENCY = 8
+
+DEFAULT_MAX_BATCHES_PER_LEVEL = 10
+
+# Number of certificates serialized at a time; this bounds how much of the
+# output is held in memory when it is streamed to S3
+SERIALIZE_CHUNK_SIZE = 100
+
+# NB: AWS API doesn't allow to describe more than 50 parameters at a time
+SSM_DESCRIBE_PARAMETERS_MAX = 50
+
+# Upper bounds, in days to expiry, of the buckets certificates are counted in
+# for the expiry metrics
+EXPIRY_METRICS_BUCKETS = [7, 15, 30, 60, 90]
+
+DEFAULT_METRICS_NAMESPACE = "ArkCase/PKI"
+
+DEFAULT_SCAN_CACHE_KEY = "scan-cache/manifest.json.gz"
+
+# Bump this whenever the format of the scan manifest changes
+SCAN_MANIFEST_VERSION = 3
+
+DEFAULT_PLAN_SHARD_SIZE = 50
+
+# S3 multipart uploads require all the parts but the last one to be at least
+# 5MiB
+S3_PART_SIZE = 8 * 1024 * 1024
 
 
 def handler(event, context):
     """
-    **IMPORTANT**: Make sure you give enough RAM to this function as all
-                   the certificates will be loaded in RAM to compute their
-                   dependencies and build a hierarchical tree.
+    **IMPORTANT**: Make sure you give enough RAM to this function as a
+                   compact record of every certificate will be kept in RAM to
+                   compute their dependencies and build a hierarchical tree.
 
     This Lambda function can operate in two different modes depending on its
     arguments:
@@ -40,6 +81,92 @@ def handler(event, context):
       - S3_BUCKET: Name of the S3 bucket where to save temporary data and
         also the output of this function
 
+    The following environment variables are optional:
+      - MAX_CONCURRENCY: Maximum number of concurrent SSM requests and of
+        certificate parsing workers; default to 8. SSM throttles requests per
+        account, so lower this if other workloads share the same account and
+        region; set it to 1 to scan and parse sequentially.
+      - OUTPUT_FORMAT: Format of the output file; can be "json" (the default)
+        for a single JSON array, "ndjson" for one JSON object per line,
+        streamed to S3 as the certificates are serialized, or "sharded" for
+        JSON arrays of `PLAN_SHARD_SIZE` certificates each plus a small
+        JSON index object listing them
+      - OUTPUT_COMPRESSION: Set to "gzip" to compress the output file (or
+        the shards); only valid with the "ndjson" and "sharded" output
+        formats
+      - PLAN_SHARD_SIZE: Number of certificates per shard for the "sharded"
+        output format; default to 50, values below 1 are treated as 1
+      - SCAN_CACHE_KEY: S3 key in `S3_BUCKET` of the manifest of the
+        previous scan; default to "scan-cache/manifest.json.gz". Only the
+        certificates whose parameter version changed since the previous scan
+        are downloaded and parsed again. Set to an empty string to disable
+        the manifest and always perform a full scan.
+      - CASCADE_DISCOVERY: How to find the dependent certificates in
+        "cascade" mode; can be "scan" (the default) to scan all the
+        certificates, or "tags" to only look up the certificates whose
+        `IssuerCertParameterName` tag points to the parent certificate or one
+        of its dependents. Only use "tags" once all the certificates have
+        been issued or renewed by a version of `libarkcert` that sets this
+        tag.
+      - SCAN_TARGETS: JSON list of the accounts and regions to scan, each
+        scanned concurrently with its own SSM client; by default, only the
+        Parameter Store of this Lambda function's account and region is
+        scanned. Each target looks like this:
+
+            {
+              "Name": "prod-eu",  # Optional; default to the account and region
+              "Region": "eu-west-1",  # Optional; default to this Lambda function's region
+              "RoleArn": "arn:aws:iam::123456789012:role/XYZ",  # Role to assume, optional
+              "ExternalId": "XYZ",  # External ID to assume the role, optional
+              "Paths": ["/XYZ/pki/certs"]  # Optional; default to `CERT_PARAMETERS_PATHS`
+            }
+
+        The scan manifest of each target is saved under a folder named after
+        it next to `SCAN_CACHE_KEY`, and each certificate in the output file
+        has a `Target` field copied from its target (without `Paths`), so it
+        can be renewed in the right account and region. In "cascade" mode,
+        only the first target matching the account and region of the parent
+        certificate ARN is scanned.
+      - RENEWAL_SCHEDULING: How to select the certificates to renew in
+        "renewal" mode; can be "threshold" (the default) to renew all the
+        certificates within `HOW_MANY_DAYS_LEFT_BEFORE_RENEWING` days of
+        expiry, or "levelled" to spread renewals over
+        `RENEWAL_HORIZON_DAYS` days: each certificate is then renewed
+        between `RENEWAL_HORIZON_DAYS` and
+        `HOW_MANY_DAYS_LEFT_BEFORE_RENEWING` days before expiry, on a day
+        that depends on its parameter name
+      - RENEWAL_HORIZON_DAYS: Number of days to expiry from which a
+        certificate may be renewed early; required in "levelled" mode, must
+        not be lower than `HOW_MANY_DAYS_LEFT_BEFORE_RENEWING`
+      - MAX_RENEWALS_PER_RUN: Maximum number of certificates to renew per
+        target in "levelled" mode; certificates renewed early are postponed
+        to a later run beyond that. Certificates within
+        `HOW_MANY_DAYS_LEFT_BEFORE_RENEWING` days of expiry are always
+        renewed, even if that exceeds this limit. Default to 0 (no limit).
+      - MAX_BATCHES_PER_LEVEL: Maximum number of batches each level of the
+        output list is split into, i.e. the maximum number of certificates
+        renewed concurrently; default to 10
+      - EXPIRY_METRICS: Set to "run" to log the expiry metrics of each scan
+        in CloudWatch Embedded Metric Format: `MinDaysToExpiry`,
+        `CertificateCount`, `ScanDuration` and the number of certificates per
+        bucket of days to expiry (`ExpiredCertificates`,
+        `CertificatesExpiringIn0To7Days`, ...,
+        `CertificatesExpiringIn90DaysOrMore`), with a `Target` dimension.
+        Set to "all" to also log the `DaysToExpiry` of each certificate, with
+        the `Target` and `CertParameterName` dimensions. Default to "none".
+        No metrics are logged when the certificates are not scanned (i.e.
+        with `CASCADE_DISCOVERY` set to "tags").
+      - METRICS_NAMESPACE: CloudWatch namespace of the expiry metrics;
+        default to "ArkCase/PKI"
+      - VERIFY_PRIVATE_KEYS: Set to "true" to also fetch and decrypt the
+        private key of each certificate to renew and check that it matches
+        the certificate; by default, the key type and size are taken from
+        the certificate's public key and private keys are never fetched
+      - REUSE_LEAF_KEYS: Set to "true" to set the `ReuseKey` field of each
+        certificate to renew that is not a CA, so only the certificate is
+        re-signed and its existing private key is kept; by default, a new
+        private key is generated for each certificate
+
     The input event must look like this:
 
         {
@@ -47,29 +174,78 @@ def handler(event, context):
             # just be renewed; this field is optional and will operate the
             # Lambda function in "cascade" mode; if this field is absent, the
             # Lambda function will work in "renewal" mode.
-            "ParentCertParameterArn": "arn:aws:..."
+            "ParentCertParameterArn": "arn:aws:...",
+
+            # Whether to ignore the manifest of the previous scan and
+            # download and parse all the certificates again; optional,
+            # default to `false`
+            "FullRescan": false
         }
 
     This Lambda function returns something like this:
 
         {
           "S3Bucket": "XYZ",  # S3 bucket where the output file is located
-          "S3Key": "XYZ",     # S3 key to the output file; the content will be in JSON
-          "Count": 17         # The number of certificates to be renewed (i.e. the length of the list)
+          "S3Key": "XYZ",     # S3 key to the output file; the content will be in JSON,
+                              # or in NDJSON if the key ends in ".ndjson" or ".ndjson.gz";
+                              # if the JSON content is an object rather than an array, it
+                              # is the index of a sharded list
+          "Count": 17,        # The number of certificates to be renewed (i.e. the length of the list)
+
+          # The certificates of the list are sorted by depth in their tree
+          # (each one has a `Depth` field); each level is the range of the
+          # certificates of a given depth, split into batches that can be
+          # renewed concurrently once the previous levels are renewed
+          "Levels": [
+            {
+              "Depth": 1,
+              "Start": 0,  # Index of the first certificate of the level
+              "End": 2,    # Index after the last certificate of the level
+              "Batches": [
+                {"Start": 0, "End": 1},
+                {"Start": 1, "End": 2}
+              ]
+            },
+            ...
+          ],
+
+          # How long it took to scan each target and select the certificates
+          # to renew, in seconds
+          "ScanSeconds": {"default": 4.2},
+
+          # Only in "renewal" mode when no certificate is due for renewal:
+          # the date from which a certificate will be due for renewal (or
+          # for early renewal, in "levelled" mode)
+          "NothingDueUntil": "2020-12-31T09:41:00"
         }
     """
 
     print(f"Received event: {event}")
-    s3key, count = handle_request(event)
-    response = {
-        'S3Bucket': os.environ['S3_BUCKET'],
-        'S3Key': s3key,
-        'Count': count
-    }
+    response = handle_request(event)
     return response
 
 
-class Certificate(NodeMixin):
+class Certificate:
+    """Compact record of a certificate stored in the Parameter Store
+
+    Only what is needed to build the trees and check for expiry is kept; the
+    full X.509 certificate is parsed again in `serialize()` for the
+    certificates that are actually going to be renewed.
+    """
+    __slots__ = (
+        'cert_parameter_arn',
+        'cert_parameter_name',
+        'key_parameter_name',
+        'ca_key_parameter_name',
+        'ca_cert_parameter_name',
+        'chain_parameter_name',
+        'is_ca',
+        'not_valid_after',
+        'subject_hash',
+        'issuer_hash',
+        'version',
+    )
+
     def __init__(
             self,
             cert_parameter_arn,
@@ -77,56 +253,127 @@ class Certificate(NodeMixin):
             key_parameter_name,
             ca_key_parameter_name,
             ca_cert_parameter_name,
-            cert,
-            parent=None,
-            children=None
+            is_ca,
+            not_valid_after,
+            subject_hash,
+            issuer_hash,
+            version=None,
+            chain_parameter_name=None
     ):
         self.cert_parameter_arn = cert_parameter_arn
         self.cert_parameter_name = cert_parameter_name
         self.key_parameter_name = key_parameter_name
         self.ca_key_parameter_name = ca_key_parameter_name
         self.ca_cert_parameter_name = ca_cert_parameter_name
-        self.cert = cert
-
-        # Determine whether this certificate is a CA or not
-        try:
-            basic_constraints = cert.extensions.get_extension_for_oid(ExtensionOID.BASIC_CONSTRAINTS)
-            self.is_ca = basic_constraints.value.ca
-        except x509.ExtensionNotFound:
-            self.is_ca = False
-
-        # Check if this certificate is close to expiry
-        remaining_delta = cert.not_valid_after - datetime.datetime.utcnow()
-        remaining_days = remaining_delta.days
-        self.renewal_needed = remaining_days <= int(os.environ['HOW_MANY_DAYS_LEFT_BEFORE_RENEWING'])
+        self.chain_parameter_name = chain_parameter_name
+        self.is_ca = is_ca
+        self.not_valid_after = not_valid_after
+        self.subject_hash = subject_hash
+        self.issuer_hash = issuer_hash
+        self.version = version
 
-        # NodeMixin stuff
-        self.parent = parent
-        if children:
-            self.children
+    @property
+    def is_root(self):
+        return self.subject_hash == self.issuer_hash
 
     def __repr__(self):
         return f"<Certificate({self.cert_parameter_name})>"
 
 
+class ExpiryIndex:
+    """Certificates sorted by expiry date, then by parameter name
+
+    When the `manifest` of the previous scan is given, its expiry order is
+    reused for the certificates that didn't change, and only the new or
+    changed certificates are inserted.
+    """
+    def __init__(self, certificates, manifest=None):
+        previous_order = manifest.get('ExpiryOrder') if manifest else None
+        if previous_order is None:
+            ordered = sorted(certificates, key=self.sort_key)
+            self.keys = [self.sort_key(certificate) for certificate in ordered]
+            self.certificates = ordered
+            return
+
+        entries = manifest['Certificates']
+        by_name = {certificate.cert_parameter_name: certificate for certificate in certificates}
+        self.keys = []
+        self.certificates = []
+        for name in previous_order:
+            certificate = by_name.pop(name, None)
+            if certificate and certificate.version == entries[name]['Version']:
+                self.keys.append(self.sort_key(certificate))
+                self.certificates.append(certificate)
+            elif certificate:
+                by_name[name] = certificate  # Changed since the previous scan
+        for certificate in by_name.values():
+            key = self.sort_key(certificate)
+            i = bisect.bisect_right(self.keys, key)
+            self.keys.insert(i, key)
+            self.certificates.insert(i, certificate)
+
+    @staticmethod
+    def sort_key(certificate):
+        return (certificate.not_valid_after, certificate.cert_parameter_name)
+
+    def expiring_before(self, deadline):
+        """Return the certificates that expire strictly before `deadline`,
+        soonest first
+        """
+        return self.certificates[:self.count_expiring_before(deadline)]
+
+    def count_expiring_before(self, deadline):
+        return bisect.bisect_left(self.keys, (deadline,))
+
+    def nothing_due_until(self, how_many_days_left_before_renewing, horizon_days=None):
+        """Return the date from which the first certificate will be due for
+        renewal, or `None` if there are no certificates
+
+        In "levelled" mode, i.e. with a `horizon_days`, this is the earliest
+        levelled renewal date if it comes first (see
+        `get_levelled_renewal_date()`).
+        """
+        if not self.keys:
+            return None
+        result = self.keys[0][0] - datetime.timedelta(days=how_many_days_left_before_renewing + 1)
+        if horizon_days is not None:
+            # NB: The levelled renewal date of a certificate is at most
+            #     `horizon_days - how_many_days_left_before_renewing` days
+            #     before its own threshold date, so only the certificates
+            #     expiring within that many days of the first one can come
+            #     before `result`
+            deadline = self.keys[0][0] + datetime.timedelta(days=horizon_days - how_many_days_left_before_renewing)
+            for certificate in self.expiring_before(deadline):
+                renewal_date = get_levelled_renewal_date(certificate, how_many_days_left_before_renewing, horizon_days)
+                result = min(result, renewal_date)
+        return result
+
+    def names(self):
+        return [certificate.cert_parameter_name for certificate in self.certificates]
+
+
+def hash_name(name):
+    """Compute a short digest of an X.509 name, which is enough to tell
+    whether a certificate is self-signed
+    """
+    return hashlib.blake2b(name.public_bytes(default_backend()), digest_size=8).digest()
+
+
 def make_certificate_from_parameter(parameter):
     """Take the `parameter` input, which must be from SSM `GetParameter()` or
-    equivalent, and build a certificate object from that. The returned
-    certificate object won't be part of a tree.
+    equivalent, and build a compact certificate record from that. The parsed
+    X.509 certificate is not kept.
     """
     # Load this certificate
     cert_parameter_arn = parameter['ARN']
     cert_parameter_name = parameter['Name']
-    cert_value = parameter['Value']
-    cert = x509.load_pem_x509_certificate(
-        cert_value.encode('utf8'),
-        backend=default_backend()
-    )
+    cert = load_certificate(parameter['Value'])
 
     # Inspect `dnQualifier` attributes for this certificate
     key_parameter_name = None
     ca_key_parameter_name = None
     ca_cert_parameter_name = None
+    chain_parameter_name = None
     attributes = cert.subject.get_attributes_for_oid(NameOID.DN_QUALIFIER)
     for attribute in attributes:
         name, value = attribute.value.split(":", 1)
@@ -136,290 +383,1340 @@ def make_certificate_from_parameter(parameter):
             ca_key_parameter_name = value
         elif name == "cacert":
             ca_cert_parameter_name = value
+        elif name == "chain":
+            chain_parameter_name = value
         else:
             print(f"WARNING: Unknown dnQualifier attribute '{name}' for certificate {cert_parameter_name}; ignored")
     if not key_parameter_name:
         raise KeyError(f"dnQualifier doesn't contain the key parameter name for certificate {cert_parameter_name}")
 
+    # Determine whether this certificate is a CA or not
+    try:
+        basic_constraints = cert.extensions.get_extension_for_oid(ExtensionOID.BASIC_CONSTRAINTS)
+        is_ca = basic_constraints.value.ca
+    except x509.ExtensionNotFound:
+        is_ca = False
+
     return Certificate(
         cert_parameter_arn=cert_parameter_arn,
         cert_parameter_name=cert_parameter_name,
         key_parameter_name=key_parameter_name,
         ca_key_parameter_name=ca_key_parameter_name,
         ca_cert_parameter_name=ca_cert_parameter_name,
-        cert=cert
+        is_ca=is_ca,
+        not_valid_after=cert.not_valid_after,
+        subject_hash=hash_name(cert.subject),
+        issuer_hash=hash_name(cert.issuer),
+        version=parameter.get('Version'),
+        chain_parameter_name=chain_parameter_name
     )
 
 
-def find_certificate_by_arn(certificates, arn):
-    for certificate in certificates:
-        if certificate.cert_parameter_arn == arn:
-            return certificate
-    raise KeyError(f"Certificate not found: {arn}")
+def load_certificate(cert_value):
+    return x509.load_pem_x509_certificate(
+        cert_value.encode('utf8'),
+        backend=default_backend()
+    )
 
 
-def find_certificate_by_name(certificates, name):
-    for certificate in certificates:
-        if certificate.cert_parameter_name == name:
-            return certificate
-    raise KeyError(f"Certificate not found: {name}")
+class CertificateIndex:
+    """Lookup tables built in a single pass over the list of certificates.
+
+    `children` maps the name of a CA certificate parameter to the list of
+    certificates it has signed, so that walking down a tree never requires
+    rescanning the whole list of certificates.
+    """
+    def __init__(self, certificates):
+        self.certificates = certificates
+        self.by_arn = {}
+        self.by_name = {}
+        self.children = {}
+        for certificate in certificates:
+            self.by_arn[certificate.cert_parameter_arn] = certificate
+            self.by_name[certificate.cert_parameter_name] = certificate
+            ca_cert_parameter_name = certificate.ca_cert_parameter_name
+            if ca_cert_parameter_name and ca_cert_parameter_name != certificate.cert_parameter_name:
+                self.children.setdefault(ca_cert_parameter_name, []).append(certificate)
+
+    def get_children(self, certificate):
+        return self.children.get(certificate.cert_parameter_name, [])
+
+
+def find_certificate_by_arn(index, arn):
+    try:
+        return index.by_arn[arn]
+    except KeyError:
+        raise KeyError(f"Certificate not found: {arn}")
+
+
+def find_certificate_by_name(index, name):
+    try:
+        return index.by_name[name]
+    except KeyError:
+        raise KeyError(f"Certificate not found: {name}")
 
 
 def handle_request(event):
-    # Fetch all the parameters containing the certificates
-    cert_parameters_paths = os.environ['CERT_PARAMETERS_PATHS'].split(":")
-    ssm = boto3.client("ssm")
-    parameters = []
-    for path in cert_parameters_paths:
-        parameters += collect_cert_parameters(ssm, path)
-
-    # Build a list of certificates to inspect
-    certificates = []
-    for parameter in parameters:
-        certificate = make_certificate_from_parameter(parameter)
-        certificates.append(certificate)
+    s3 = boto3.client("s3")
+    bucket = os.environ['S3_BUCKET']
+    response = {'S3Bucket': bucket}
+
+    targets = get_scan_targets()
+    if 'ParentCertParameterArn' in event and len(targets) > 1:
+        arn = event['ParentCertParameterArn']
+        targets = [target for target in targets if target_matches_arn(target, arn)][:1]
+        if not targets:
+            raise ValueError(f"No scan target matches the account and region of {arn}")
+
+    # Scan the targets concurrently; each target has its own SSM client and
+    # worker pools
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(targets)) as pool:
+        futures = [pool.submit(plan_target, target, event, s3, bucket) for target in targets]
+        plan = []
+        nothing_due_until = []
+        response['ScanSeconds'] = {}
+        for target, future in zip(targets, futures):
+            ssm, result, target_nothing_due_until, scan_seconds = future.result()
+            plan.append((target, ssm, result))
+            response['ScanSeconds'][get_target_name(target)] = round(scan_seconds, 3)
+            if target_nothing_due_until:
+                nothing_due_until.append(target_nothing_due_until)
+    if not any(result for target, ssm, result in plan) and nothing_due_until:
+        response['NothingDueUntil'] = min(nothing_due_until).isoformat()
+
+    # Save the certificate list in S3
+    timestamp = datetime.datetime.utcnow().strftime("%Y%m%d-%H%M%S")
+    s3key = "list of certificates to renew " + timestamp
+    output_format = os.environ.get('OUTPUT_FORMAT', "json")
+    output_compression = os.environ.get('OUTPUT_COMPRESSION', "")
+    if output_format == "json":
+        if output_compression:
+            raise ValueError(f"Output compression is not supported with the 'json' output format")
+        output = serialize(plan)
+        s3key += ".json"
+        content = json.dumps(output, indent=2)
+        s3.put_object(
+            Bucket=bucket,
+            Key=s3key,
+            ContentType="application/json",
+            Body=content
+        )
+        count = len(output)
+    elif output_format == "ndjson":
+        s3key += ".ndjson"
+        if output_compression == "gzip":
+            s3key += ".gz"
+        elif output_compression:
+            raise ValueError(f"Unsupported output compression: {output_compression}")
+        count = write_ndjson(s3, bucket, s3key, plan, output_compression)
+    elif output_format == "sharded":
+        if output_compression not in ("", "gzip"):
+            raise ValueError(f"Unsupported output compression: {output_compression}")
+        shard_size = max(1, int(os.environ.get('PLAN_SHARD_SIZE', DEFAULT_PLAN_SHARD_SIZE)))
+        s3key, count = write_shards(s3, bucket, s3key, plan, output_compression, shard_size)
+    else:
+        raise ValueError(f"Unsupported output format: {output_format}")
+    response['S3Key'] = s3key
+    response['Count'] = count
+    max_batches = int(os.environ.get('MAX_BATCHES_PER_LEVEL', DEFAULT_MAX_BATCHES_PER_LEVEL))
+    response['Levels'] = get_plan_levels(plan, max(1, max_batches))
+    return response
 
-    # Get the list of certificates to renew according to the requested mode of
-    # operation
-    if 'ParentCertParameterArn' in event:
-        result = cascade(
+
+def plan_target(target, event, s3, bucket):
+    """Scan the certificates of the given target and select the ones to renew
+
+    Returns a tuple `(ssm, certificates, nothing_due_until, scan_seconds)`
+    where `ssm` is the SSM client of the target, `certificates` is the list
+    of certificates to renew and `nothing_due_until` is the date from which
+    a certificate of this target will be due for renewal, if any and known.
+    """
+    start = time.monotonic()
+    name = get_target_name(target)
+    cert_parameters_paths = target.get('Paths') or os.environ['CERT_PARAMETERS_PATHS'].split(":")
+    ssm = make_ssm_client(make_target_session(target, "check-certificates"))
+    nothing_due_until = None
+
+    if 'ParentCertParameterArn' in event and os.environ.get('CASCADE_DISCOVERY', "scan") == "tags":
+        # Only fetch the certificates that depend on the parent certificate
+        result = cascade_by_tags(
             ssm,
-            certificates,
+            cert_parameters_paths,
             event['ParentCertParameterArn']
         )
     else:
-        result = check_renewals(
-            ssm,
-            certificates,
-            int(os.environ['HOW_MANY_DAYS_LEFT_BEFORE_RENEWING'])
+        # Fetch and parse all the certificates
+        scan_cache_key = get_target_scan_cache_key(target)
+        manifest = None
+        if scan_cache_key and not event.get('FullRescan', False):
+            manifest = load_scan_manifest(s3, bucket, scan_cache_key, cert_parameters_paths)
+        chain_versions = {}
+        certificates = scan_certificates(ssm, cert_parameters_paths, manifest, chain_versions)
+        expiry_index = ExpiryIndex(certificates, manifest)
+        emit_expiry_metrics(name, expiry_index, time.monotonic() - start)
+        if scan_cache_key:
+            save_scan_manifest(s3, bucket, scan_cache_key, cert_parameters_paths, certificates, expiry_index, chain_versions)
+
+        # Get the list of certificates to renew according to the requested
+        # mode of operation
+        if 'ParentCertParameterArn' in event:
+            result = cascade(
+                ssm,
+                certificates,
+                event['ParentCertParameterArn']
+            )
+        else:
+            how_many_days_left_before_renewing = int(os.environ['HOW_MANY_DAYS_LEFT_BEFORE_RENEWING'])
+            result = check_renewals(
+                ssm,
+                certificates,
+                how_many_days_left_before_renewing,
+                expiry_index
+            )
+            nothing_due_until = expiry_index.nothing_due_until(
+                how_many_days_left_before_renewing,
+                get_levelled_horizon_days(how_many_days_left_before_renewing)
+            )
+
+    scan_seconds = time.monotonic() - start
+    print(f"Target {name}: {len(result)} certificates to renew, scanned in {scan_seconds:.1f}s")
+    return ssm, result, nothing_due_until, scan_seconds
+
+
+def emit_expiry_metrics(target_name, expiry_index, scan_seconds):
+    """Log the expiry metrics of a scan in CloudWatch Embedded Metric Format,
+    according to the `EXPIRY_METRICS` environment variable
+
+    As the certificates are sorted by expiry date in the `expiry_index`, the
+    number of certificates per bucket is found by bisection.
+    """
+    mode = os.environ.get('EXPIRY_METRICS', "none")
+    if mode == "none":
+        return
+    if mode not in ("run", "all"):
+        raise ValueError(f"Invalid EXPIRY_METRICS: {mode}")
+    namespace = os.environ.get('METRICS_NAMESPACE', DEFAULT_METRICS_NAMESPACE)
+    now = datetime.datetime.utcnow()
+
+    def days_to_expiry(not_valid_after):
+        return round((not_valid_after - now).total_seconds() / 86400, 2)
+
+    if mode == "all":
+        for not_valid_after, cert_parameter_name in expiry_index.keys:
+            print_emf_record(
+                namespace,
+                {'Target': target_name, 'CertParameterName': cert_parameter_name},
+                {'DaysToExpiry': (days_to_expiry(not_valid_after), "None")}
+            )
+
+    metrics = {
+        'CertificateCount': (len(expiry_index.keys), "Count"),
+        'ScanDuration': (round(scan_seconds, 3), "Seconds")
+    }
+    if expiry_index.keys:
+        metrics['MinDaysToExpiry'] = (days_to_expiry(expiry_index.keys[0][0]), "None")
+    previous = expiry_index.count_expiring_before(now)
+    metrics['ExpiredCertificates'] = (previous, "Count")
+    lower_bound = 0
+    for upper_bound in EXPIRY_METRICS_BUCKETS:
+        count = expiry_index.count_expiring_before(now + datetime.timedelta(days=upper_bound))
+        metrics[f"CertificatesExpiringIn{lower_bound}To{upper_bound}Days"] = (count - previous, "Count")
+        previous = count
+        lower_bound = upper_bound
+    metrics[f"CertificatesExpiringIn{lower_bound}DaysOrMore"] = (len(expiry_index.keys) - previous, "Count")
+    print_emf_record(namespace, {'Target': target_name}, metrics)
+
+
+def print_emf_record(namespace, dimensions, metrics):
+    """Log one record in CloudWatch Embedded Metric Format
+
+    `metrics` maps metric names to `(value, unit)` tuples.
+    """
+    record = {
+        '_aws': {
+            'Timestamp': int(time.time() * 1000),
+            'CloudWatchMetrics': [
+                {
+                    'Namespace': namespace,
+                    'Dimensions': [list(dimensions)],
+                    'Metrics': [{'Name': name, 'Unit': unit} for name, (value, unit) in metrics.items()]
+                }
+            ]
+        }
+    }
+    record.update(dimensions)
+    record.update({name: value for name, (value, unit) in metrics.items()})
+    print(json.dumps(record))
+
+
+def get_scan_targets():
+    """Get the list of targets to scan from the `SCAN_TARGETS` environment
+    variable
+
+    The default target, i.e. the account and region of this Lambda function,
+    is an empty dict.
+    """
+    targets = json.loads(os.environ.get('SCAN_TARGETS') or "[]")
+    if not targets:
+        return [{}]
+    names = [get_target_name(target) for target in targets]
+    if len(set(names)) != len(names):
+        raise ValueError(f"Scan targets must have unique names: {names}")
+    return targets
+
+
+def get_target_name(target):
+    if 'Name' in target:
+        return target['Name']
+    items = []
+    if 'RoleArn' in target:
+        items.append(target['RoleArn'].split(":")[4])
+    if 'Region' in target:
+        items.append(target['Region'])
+    return "-".join(items) or "default"
+
+
+def target_matches_arn(target, arn):
+    """Check whether the given ARN belongs to the account and region of the
+    given target, as far as the target specifies them
+    """
+    arn_items = arn.split(":")
+    region = target.get('Region', os.environ.get('AWS_REGION'))
+    if region and arn_items[3] != region:
+        return False
+    if 'RoleArn' in target and arn_items[4] != target['RoleArn'].split(":")[4]:
+        return False
+    return True
+
+
+def get_target_scan_cache_key(target):
+    """Get the S3 key of the scan manifest of the given target; this is
+    `SCAN_CACHE_KEY` for the default target
+    """
+    scan_cache_key = os.environ.get('SCAN_CACHE_KEY', DEFAULT_SCAN_CACHE_KEY)
+    if not scan_cache_key or not target:
+        return scan_cache_key
+    folder, filename = posixpath.split(scan_cache_key)
+    return posixpath.join(folder, get_target_name(target), filename)
+
+
+def write_ndjson(s3, bucket, key, plan, compression):
+    """Serialize the certificates of the given `plan` and stream them to S3,
+    one JSON object per line
+
+    Returns the number of certificates written.
+    """
+    extra_args = {'ContentType': "application/x-ndjson"}
+    if compression:
+        extra_args['ContentEncoding'] = compression
+    writer = S3StreamWriter(s3, bucket, key, extra_args)
+    count = 0
+    try:
+        if compression == "gzip":
+            stream = gzip.GzipFile(fileobj=writer, mode="wb")
+        else:
+            stream = writer
+        for item in iter_plan(plan):
+            stream.write(json.dumps(item).encode('utf8') + b"\n")
+            count += 1
+        if stream is not writer:
+            stream.close()  # NB: This doesn't close `writer`
+        writer.close()
+    except Exception:
+        writer.abort()
+        raise
+    return count
+
+
+def write_shards(s3, bucket, prefix, plan, compression, shard_size):
+    """Serialize the certificates of the given `plan` and save them in S3 as
+    JSON arrays of `shard_size` items each, followed by an index object
+    listing the shards
+
+    Consumers only need to fetch the index and the shard that contains the
+    item they are interested in. The index looks like this:
+
+        {
+          "Format": "sharded",
+          "Count": 117,       # Total number of items
+          "ShardSize": 50,    # Number of items per shard (except the last one)
+          "Shards": [         # S3 keys of the shards, in order
+            "XYZ/shard-00000.json.gz",
+            ...
+          ]
+        }
+
+    Returns a tuple `(index_key, count)`.
+    """
+    shard_keys = []
+    count = 0
+    shard = []
+
+    def save_shard():
+        key = f"{prefix}/shard-{len(shard_keys):05d}.json"
+        content = json.dumps(shard).encode('utf8')
+        extra_args = {'ContentType': "application/json"}
+        if compression == "gzip":
+            key += ".gz"
+            content = gzip.compress(content)
+            extra_args['ContentEncoding'] = compression
+        s3.put_object(Bucket=bucket, Key=key, Body=content, **extra_args)
+        shard_keys.append(key)
+
+    for item in iter_plan(plan):
+        shard.append(item)
+        count += 1
+        if len(shard) == shard_size:
+            save_shard()
+            shard = []
+    if shard:
+        save_shard()
+
+    index_key = f"{prefix}/index.json"
+    index = {
+        'Format': "sharded",
+        'Count': count,
+        'ShardSize': shard_size,
+        'Shards': shard_keys
+    }
+    s3.put_object(
+        Bucket=bucket,
+        Key=index_key,
+        ContentType="application/json",
+        Body=json.dumps(index, indent=2)
+    )
+    print(f"Saved {count} certificates in {len(shard_keys)} shards; index: s3://{bucket}/{index_key}")
+    return index_key, count
+
+
+class S3StreamWriter(io.RawIOBase):
+    """Write-only file object that uploads what is written to it to S3
+
+    The data is sent as a multipart upload, one part each time `S3_PART_SIZE`
+    bytes have been written, so that only one part is held in memory at any
+    time. If less than one part has been written when the stream is closed,
+    it is uploaded with a single `PutObject` instead.
+    """
+    def __init__(self, s3, bucket, key, extra_args):
+        self.s3 = s3
+        self.bucket = bucket
+        self.key = key
+        self.extra_args = extra_args
+        self.buffer = bytearray()
+        self.upload_id = None
+        self.parts = []
+        self.completed = False
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.buffer += data
+        while len(self.buffer) >= S3_PART_SIZE:
+            self.upload_part(bytes(self.buffer[:S3_PART_SIZE]))
+            del self.buffer[:S3_PART_SIZE]
+        return len(data)
+
+    def upload_part(self, data):
+        if self.upload_id is None:
+            response = self.s3.create_multipart_upload(
+                Bucket=self.bucket,
+                Key=self.key,
+                **self.extra_args
+            )
+            self.upload_id = response['UploadId']
+        part_number = len(self.parts) + 1
+        print(f"Uploading part {part_number} of s3://{self.bucket}/{self.key}")
+        response = self.s3.upload_part(
+            Bucket=self.bucket,
+            Key=self.key,
+            UploadId=self.upload_id,
+            PartNumber=part_number,
+            Body=data
         )
+        self.parts.append({'ETag': response['ETag'], 'PartNumber': part_number})
 
-    # Save the certificate list in S3
-    output = serialize(ssm, result)
-    timestamp = datetime.datetime.utcnow().strftime("%Y%m%d-%H%M%S")
-    s3key = "list of certificates to renew " + timestamp + ".json"
-    content = json.dumps(output, indent=2)
-    s3 = boto3.client("s3")
+    def close(self):
+        if self.closed:
+            return
+        if not self.completed:
+            if self.upload_id is None:
+                self.s3.put_object(
+                    Bucket=self.bucket,
+                    Key=self.key,
+                    Body=bytes(self.buffer),
+                    **self.extra_args
+                )
+            else:
+                if self.buffer:
+                    self.upload_part(bytes(self.buffer))
+                self.s3.complete_multipart_upload(
+                    Bucket=self.bucket,
+                    Key=self.key,
+                    UploadId=self.upload_id,
+                    MultipartUpload={'Parts': self.parts}
+                )
+            self.buffer = bytearray()
+            self.completed = True
+        super().close()
+
+    def abort(self):
+        """Discard what has been written so far"""
+        if self.upload_id is not None and not self.completed:
+            self.s3.abort_multipart_upload(
+                Bucket=self.bucket,
+                Key=self.key,
+                UploadId=self.upload_id
+            )
+        self.buffer = bytearray()
+        self.completed = True
+        super().close()
+
+
+def get_max_concurrency():
+    return max(1, int(os.environ.get('MAX_CONCURRENCY', DEFAULT_MAX_CONCURRENCY)))
+
+
+def make_ssm_client(session=None):
+    """Create an SSM client that can be shared by `get_max_concurrency()`
+    threads and that backs off when SSM throttles our requests.
+
+    The client is created from the given boto3 `session`, if any.
+    """
+    config = botocore.config.Config(
+        max_pool_connections=max(10, get_max_concurrency()),
+        retries={
+            'max_attempts': 10,
+            'mode': "adaptive"
+        }
+    )
+    return (session or boto3).client("ssm", config=config)
+
+
+def scan_certificates(ssm, paths, manifest=None, chain_versions=None):
+    """Fetch the certificates stored under the given `paths` and build
+    certificate objects from them.
+
+    Each path is scanned in its own thread, and each page of parameters is
+    parsed by a pool of workers while the next pages are being fetched. At
+    most `get_max_concurrency()` paths are scanned at the same time.
+
+    If the `manifest` of a previous scan is given, only the parameters that
+    are new or whose version changed are downloaded and parsed; the other
+    certificates are rebuilt from the manifest.
+
+    The chain parameters stored under the `paths` are skipped (see
+    `make_certificates_from_parameters()`); if a `chain_versions` dict is
+    given, their versions are saved in it by name, for the manifest.
+
+    The certificates are returned in the order of `paths` and, for each
+    path, in the order returned by SSM.
+    """
+    max_concurrency = get_max_concurrency()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_concurrency) as parsers:
+
+        def scan_path(path):
+            if manifest is not None:
+                return scan_path_incrementally(ssm, path, manifest, parsers, chain_versions)
+            futures = []
+            for page in iter_cert_parameter_pages(ssm, path):
+                futures.append(parsers.submit(make_certificates_from_parameters, page, chain_versions))
+            return futures
+
+        scanners_count = min(len(paths), max_concurrency)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=scanners_count) as scanners:
+            path_futures = [scanners.submit(scan_path, path) for path in paths]
+            certificates = []
+            for path_future in path_futures:
+                for part in path_future.result():
+                    if isinstance(part, concurrent.futures.Future):
+                        certificates += part.result()
+                    else:
+                        certificates += part
+
+    if manifest is not None:
+        names = set(certificate.cert_parameter_name for certificate in certificates)
+        deleted_count = sum(1 for name in manifest['Certificates'] if name not in names)
+        print(f"Incremental scan: {len(certificates)} certificates, {deleted_count} deleted since the previous scan")
+    return certificates
+
+
+def scan_path_incrementally(ssm, path, manifest, parsers, chain_versions=None):
+    """Scan the metadata of the parameters stored under `path` and compare
+    their versions with the `manifest` of the previous scan
+
+    The chain parameters that didn't change are neither fetched nor parsed
+    again, but their versions are kept in `chain_versions`, if given.
+
+    Returns a list whose items are either lists of certificates rebuilt from
+    the manifest, or futures of lists of certificates being parsed.
+    """
+    entries = manifest['Certificates']
+    chains = manifest['Chains']
+    parts = []
+    unchanged = []
+    changed_names = []
+    changed_count = 0
+    for page in iter_parameter_metadata_pages(ssm, path):
+        for metadata in page:
+            name = metadata['Name']
+            entry = entries.get(name)
+            if entry and entry['Version'] == metadata['Version']:
+                unchanged.append(make_certificate_from_manifest_entry(name, entry))
+                continue
+            if name in chains and chains[name] == metadata['Version']:
+                if chain_versions is not None:
+                    chain_versions[name] = metadata['Version']
+                continue
+            changed_names.append(name)
+            changed_count += 1
+            if len(changed_names) == SSM_GET_PARAMETERS_MAX:
+                parts.append(unchanged)
+                unchanged = []
+                parts.append(fetch_and_parse(ssm, changed_names, parsers, chain_versions))
+                changed_names = []
+    parts.append(unchanged)
+    if changed_names:
+        parts.append(fetch_and_parse(ssm, changed_names, parsers, chain_versions))
+    print(f"Path {path}: {changed_count} new or changed certificates")
+    return parts
+
+
+def fetch_and_parse(ssm, names, parsers, chain_versions=None):
+    response = ssm.get_parameters(Names=names)
+    for name in response.get('InvalidParameters', []):
+        # Deleted between `describe_parameters()` and `get_parameters()`
+        print(f"WARNING: Certificate parameter {name} not found; ignored")
+    return parsers.submit(make_certificates_from_parameters, response['Parameters'], chain_versions)
+
+
+def iter_parameter_metadata_pages(ssm, path):
+    """Generator yielding the metadata (but not the values) of the parameters
+    stored under `path`, one page at a time
+    """
+    kwargs = {
+        'ParameterFilters': [
+            {
+                'Key': "Path",
+                'Option': "Recursive",
+                'Values': [path]
+            }
+        ],
+        'MaxResults': SSM_DESCRIBE_PARAMETERS_MAX
+    }
+    while True:
+        response = ssm.describe_parameters(**kwargs)
+        yield response['Parameters']
+        if 'NextToken' not in response:
+            break
+        kwargs['NextToken'] = response['NextToken']
+
+
+def load_scan_manifest(s3, bucket, key, paths):
+    """Load the manifest of the previous scan
+
+    Returns `None` if there is no usable manifest, in which case a full scan
+    must be performed.
+    """
+    try:
+        response = s3.get_object(Bucket=bucket, Key=key)
+        manifest = json.loads(gzip.decompress(response['Body'].read()).decode('utf8'))
+    except Exception as e:
+        print(f"No usable scan manifest s3://{bucket}/{key} ({e}); performing a full scan")
+        return None
+    if manifest.get('ManifestVersion') != SCAN_MANIFEST_VERSION:
+        print(f"Scan manifest s3://{bucket}/{key} has an unsupported format; performing a full scan")
+        return None
+    if manifest.get('Paths') != paths:
+        print(f"Certificate parameter paths changed since the previous scan; performing a full scan")
+        return None
+    print(f"Loaded scan manifest s3://{bucket}/{key} with {len(manifest['Certificates'])} certificates")
+    return manifest
+
+
+def save_scan_manifest(s3, bucket, key, paths, certificates, expiry_index, chain_versions=None):
+    manifest = {
+        'ManifestVersion': SCAN_MANIFEST_VERSION,
+        'Paths': paths,
+        'Certificates': {
+            certificate.cert_parameter_name: make_manifest_entry(certificate)
+            for certificate in certificates
+        },
+        'Chains': chain_versions or {},  # Version of each chain parameter under `paths`, by name
+        'ExpiryOrder': expiry_index.names()
+    }
+    content = json.dumps(manifest, separators=(",", ":")).encode('utf8')
     s3.put_object(
-        Bucket=os.environ['S3_BUCKET'],
-        Key=s3key,
+        Bucket=bucket,
+        Key=key,
         ContentType="application/json",
-        Body=content
+        ContentEncoding="gzip",
+        Body=gzip.compress(content)
     )
-    return s3key, len(output)
+    print(f"Saved scan manifest s3://{bucket}/{key} with {len(certificates)} certificates")
+
 
+def make_manifest_entry(certificate):
+    return {
+        'Version': certificate.version,
+        'ARN': certificate.cert_parameter_arn,
+        'NotValidAfter': certificate.not_valid_after.isoformat(),
+        'KeyParameterName': certificate.key_parameter_name,
+        'CaKeyParameterName': certificate.ca_key_parameter_name,
+        'CaCertParameterName': certificate.ca_cert_parameter_name,
+        'ChainParameterName': certificate.chain_parameter_name,
+        'IsCa': certificate.is_ca,
+        'SubjectHash': certificate.subject_hash.hex(),
+        'IssuerHash': certificate.issuer_hash.hex()
+    }
 
-def collect_cert_parameters(ssm, path):
+
+def make_certificate_from_manifest_entry(name, entry):
+    return Certificate(
+        cert_parameter_arn=entry['ARN'],
+        cert_parameter_name=name,
+        key_parameter_name=entry['KeyParameterName'],
+        ca_key_parameter_name=entry['CaKeyParameterName'],
+        ca_cert_parameter_name=entry['CaCertParameterName'],
+        is_ca=entry['IsCa'],
+        not_valid_after=datetime.datetime.fromisoformat(entry['NotValidAfter']),
+        subject_hash=bytes.fromhex(entry['SubjectHash']),
+        issuer_hash=bytes.fromhex(entry['IssuerHash']),
+        version=entry['Version'],
+        chain_parameter_name=entry['ChainParameterName']
+    )
+
+
+def make_certificates_from_parameters(parameters, chain_versions=None):
+    """Build the certificate records of the given parameters, skipping the
+    chain parameters; the versions of those are saved in `chain_versions` by
+    name, if given
+    """
     result = []
+    for parameter in parameters:
+        certificate = make_certificate_from_parameter(parameter)
+        if certificate.chain_parameter_name == certificate.cert_parameter_name:
+            # NB: This is the chain parameter of the certificate (which
+            #     starts with the certificate), not the certificate parameter
+            if chain_versions is not None:
+                chain_versions[certificate.cert_parameter_name] = certificate.version
+            continue
+        result.append(certificate)
+    return result
+
+
+def iter_cert_parameter_pages(ssm, path):
+    """Generator yielding the parameters stored under `path`, one page at a
+    time
+    """
     has_more = True
     next_token = ""
     while has_more:
-        # NB: AWS API doesn't allow to get more than 10 parameters at a time
         if next_token:
             response = ssm.get_parameters_by_path(
                 Path=path,
                 Recursive=True,
-                MaxResults=10,
+                MaxResults=SSM_GET_PARAMETERS_MAX,
                 NextToken=next_token
             )
         else:
             response = ssm.get_parameters_by_path(
                 Path=path,
                 Recursive=True,
-                MaxResults=10
+                MaxResults=SSM_GET_PARAMETERS_MAX
             )
-        result += response['Parameters']
+        yield response['Parameters']
         if 'NextToken' in response:
             next_token = response['NextToken']
         else:
             has_more = False
-    return result
 
 
 def cascade(ssm, certificates, parent_cert_parameter_arn):
-    parent_certificate = find_certificate_by_arn(certificates, parent_cert_parameter_arn)
+    """Build the list of `(certificate, depth)` tuples of the parent
+    certificate and all the certificates that depend on it, parents first
+    """
+    index = CertificateIndex(certificates)
+    parent_certificate = find_certificate_by_arn(index, parent_cert_parameter_arn)
+    ancestors = get_ancestors(index, parent_certificate)
+    parent_depth = len(ancestors) if ancestors is not None else 0
+
+    # Build the list of certificates to renew from the tree rooted on the
+    # parent certificate
+    result = [
+        (certificate, parent_depth + depth)
+        for certificate, parent, depth in walk_forest(index, [parent_certificate])
+    ]
+    return result
 
-    # Build a tree rooted on the parent certificate
-    build_tree(certificates, parent_certificate)
-    # print(RenderTree(parent_certificate))
 
-    # Build the list of certificates to renew
-    result = [certificate for certificate in LevelOrderIter(parent_certificate)]
-    # print(f"cascade result: {result}")
+def cascade_by_tags(ssm, paths, parent_cert_parameter_arn):
+    """Build the list of certificates that depend on the given parent
+    certificate without scanning all the certificates
+
+    Returns a list of `(certificate, depth)` tuples, parents first.
+
+    The dependent certificates are found breadth-first, one level at a time,
+    by looking up the certificate parameters whose `ISSUER_TAG_KEY` tag is
+    set to the name of a certificate of the previous level. Only the
+    certificates stored under one of the `paths` are considered.
+
+    **IMPORTANT**: This relies on all the certificates having been issued or
+    renewed by a version of `libarkcert` that sets the `ISSUER_TAG_KEY` tag.
+    """
+    parent_cert_parameter_name = get_parameter_name_from_arn(parent_cert_parameter_arn)
+    response = ssm.get_parameters(Names=[parent_cert_parameter_name])
+    if not response['Parameters']:
+        raise KeyError(f"Certificate not found: {parent_cert_parameter_arn}")
+    parent_certificate = make_certificate_from_parameter(response['Parameters'][0])
+    depth = get_depth_by_links(ssm, parent_certificate)
+
+    result = [(parent_certificate, depth)]
+    visited = {parent_certificate.cert_parameter_name}
+    level = [parent_certificate]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=get_max_concurrency()) as parsers:
+        while level:
+            issuer_names = [certificate.cert_parameter_name for certificate in level]
+            child_names = []
+            for i in range(0, len(issuer_names), SSM_DESCRIBE_PARAMETERS_MAX):
+                for name in find_parameters_by_tag(ssm, ISSUER_TAG_KEY, issuer_names[i:i + SSM_DESCRIBE_PARAMETERS_MAX]):
+                    if name in visited:
+                        print(f"WARNING: Certificate {name} has already been visited; cycle detected")
+                    elif any(name.startswith(path.rstrip("/") + "/") for path in paths):
+                        visited.add(name)
+                        child_names.append(name)
+
+            futures = []
+            for i in range(0, len(child_names), SSM_GET_PARAMETERS_MAX):
+                futures.append(fetch_and_parse(ssm, child_names[i:i + SSM_GET_PARAMETERS_MAX], parsers))
+            level = []
+            for future in futures:
+                for certificate in future.result():
+                    # NB: Double-check the tag against the certificate itself
+                    if certificate.ca_cert_parameter_name in issuer_names:
+                        level.append(certificate)
+                    else:
+                        print(f"WARNING: Tag {ISSUER_TAG_KEY} of certificate {certificate.cert_parameter_name} doesn't match its CA certificate; ignored")
+            depth += 1
+            result += [(certificate, depth) for certificate in level]
+
+    print(f"Found {len(result) - 1} certificates depending on {parent_cert_parameter_name}")
     return result
 
 
-def check_renewals(ssm, certificates, how_many_days_left_before_renewing):
-    # Make a list of root (i.e. self-signed) certificates
-    root_certificates = []
-    for certificate in certificates:
-        if certificate.cert.subject == certificate.cert.issuer:
-            # This is a self-signed certificate
-            print(f"Found self-signed certificate: {certificate.cert_parameter_name}")
-            root_certificates.append(certificate)
+def get_depth_by_links(ssm, certificate):
+    """Count the ancestors of the given certificate by fetching them one
+    after the other; stop at the first missing one
+    """
+    depth = 0
+    seen = {certificate.cert_parameter_name}
+    while not certificate.is_root:
+        response = ssm.get_parameters(Names=[certificate.ca_cert_parameter_name])
+        if not response['Parameters']:
+            print(f"WARNING: CA certificate {certificate.ca_cert_parameter_name} of certificate {certificate.cert_parameter_name} not found")
+            break
+        certificate = make_certificate_from_parameter(response['Parameters'][0])
+        if certificate.cert_parameter_name in seen:
+            print(f"WARNING: Certificate {certificate.cert_parameter_name} is part of a cycle of CA certificates")
+            break
+        seen.add(certificate.cert_parameter_name)
+        depth += 1
+    return depth
 
-    # Build trees for each root certificate
-    for root_certificate in root_certificates:
-        build_tree(certificates, root_certificate)
-        # print(RenderTree(root_certificate))
 
-    # Certificates have already been checked whether they are close to expiry
-    # in their constructors. We now just need to propagate CA that are to be
-    # renewed to all dependent certificates.
-    for root_certificate in root_certificates:
-        for certificate in LevelOrderIter(root_certificate):
-            if certificate.is_ca and certificate.renewal_needed:
-                print(f"Certificate {certificate.cert_parameter_name} is due for renewal and is a CA; propagating to dependent certificates")
-                for dependent_certificate in LevelOrderIter(certificate):
-                    dependent_certificate.renewal_needed = True
+def find_parameters_by_tag(ssm, tag_key, tag_values):
+    """Generator yielding the names of the parameters whose `tag_key` tag is
+    set to one of the (at most 50) `tag_values`
+    """
+    kwargs = {
+        'ParameterFilters': [
+            {
+                'Key': "tag:" + tag_key,
+                'Values': tag_values
+            }
+        ],
+        'MaxResults': SSM_DESCRIBE_PARAMETERS_MAX
+    }
+    while True:
+        response = ssm.describe_parameters(**kwargs)
+        for parameter in response['Parameters']:
+            yield parameter['Name']
+        if 'NextToken' not in response:
+            break
+        kwargs['NextToken'] = response['NextToken']
 
-    # Build the list of certificates to renew
-    result = []
-    for root_certificate in root_certificates:
-        result += [certificate for certificate in LevelOrderIter(root_certificate) if certificate.renewal_needed]
+
+def get_parameter_name_from_arn(arn):
+    """Extract the name of a parameter from its ARN
+
+    NB: This only works for hierarchical parameter names (i.e. starting with
+        a "/"), which is the case of all the PKI parameters.
+    """
+    prefix, separator, name = arn.partition(":parameter/")
+    if not separator:
+        raise ValueError(f"Invalid parameter ARN: {arn}")
+    return "/" + name
+
+
+def check_renewals(ssm, certificates, how_many_days_left_before_renewing, expiry_index=None):
+    """Build the list of certificates that are due for renewal, along with
+    all the certificates that depend on a CA that is due for renewal
+
+    Only the certificates that expire within the given number of days (or
+    within the renewal horizon, in "levelled" mode) are looked up in
+    `expiry_index`, and the trees are walked only below the CAs that are due
+    for renewal.
+
+    In "levelled" mode (see the `RENEWAL_SCHEDULING` environment variable),
+    a certificate that expires within `RENEWAL_HORIZON_DAYS` days is renewed
+    early once it reaches its own threshold, which lies between
+    `how_many_days_left_before_renewing` and `RENEWAL_HORIZON_DAYS` days
+    before expiry and is derived from its parameter name. At most
+    `MAX_RENEWALS_PER_RUN` certificates are listed, unless more than that
+    are within `how_many_days_left_before_renewing` days of expiry: those
+    are always listed.
+
+    Returns a list of `(certificate, depth)` tuples, where `depth` is the
+    number of ancestors of the certificate. Parents are always listed before
+    their children.
+    """
+    if expiry_index is None:
+        expiry_index = ExpiryIndex(certificates)
+
+    # NB: A certificate is due for renewal when the number of whole days left
+    #     before expiry is lower or equal to `how_many_days_left_before_renewing`
+    now = datetime.datetime.utcnow()
+    margin = datetime.timedelta(days=how_many_days_left_before_renewing + 1)
+    due_certificates = expiry_index.expiring_before(now + margin)
+
+    horizon_days = get_levelled_horizon_days(how_many_days_left_before_renewing)
+    early_certificates = []
+    if horizon_days is not None:
+        horizon = now + datetime.timedelta(days=horizon_days + 1)
+        for certificate in expiry_index.expiring_before(horizon)[len(due_certificates):]:
+            renewal_date = get_levelled_renewal_date(certificate, how_many_days_left_before_renewing, horizon_days)
+            if renewal_date <= now:
+                early_certificates.append((renewal_date, certificate))
+        early_certificates = [certificate for renewal_date, certificate in sorted(early_certificates, key=lambda item: item[0])]
+
+    if not due_certificates and not early_certificates:
+        nothing_due_until = expiry_index.nothing_due_until(how_many_days_left_before_renewing, horizon_days)
+        if nothing_due_until:
+            print(f"No certificate is due for renewal; nothing due until {nothing_due_until.isoformat()}")
+        else:
+            print(f"No certificates found")
+        return []
+    print(f"{len(due_certificates)} certificates are due for renewal")
+
+    index = CertificateIndex(certificates)
+    depths = get_renewal_depths(index, due_certificates)
+
+    if early_certificates:
+        print(f"{len(early_certificates)} certificates are due for early renewal")
+        max_renewals = int(os.environ.get('MAX_RENEWALS_PER_RUN', "0"))
+        postponed_count = 0
+        for certificate in early_certificates:
+            if certificate in depths:
+                continue  # Already covered by a CA that is due for renewal
+            new_depths = {
+                dependent_certificate: depth
+                for dependent_certificate, depth in get_renewal_depths(index, [certificate]).items()
+                if dependent_certificate not in depths
+            }
+            if max_renewals and len(depths) + len(new_depths) > max_renewals:
+                postponed_count += 1
+                continue
+            depths.update(new_depths)
+        if postponed_count:
+            print(f"Early renewal of {postponed_count} certificates postponed to a later run, to renew at most {max_renewals} certificates")
+
+    # Build the list of certificates to renew, one level of the trees after
+    # the other
+    result = sorted(depths.items(), key=lambda item: item[1])
     return result
 
 
-def build_tree(certificates, root_certificate):
-    root_certificate_name = root_certificate.cert_parameter_name
-    for certificate in certificates:
-        if certificate.ca_cert_parameter_name == root_certificate_name:
-            certificate.parent = root_certificate
-            # Recurse down this certificate to build the tree
-            build_tree(certificates, certificate)
-
-
-def serialize(ssm, certificates):
-    """Serialize a list of `Certificate` objects in a list of dictionaires
-    that can be turned into JSON.
-    """
-    output = []
-    for certificate in certificates:
-        # Inspect private key to determine key type and size
-        key_parameter_name = certificate.key_parameter_name
-        cert_parameter_name = certificate.cert_parameter_name
-        print(f"Fetching private key {key_parameter_name}")
-        response = ssm.get_parameter(
-            Name=key_parameter_name,
-            WithDecryption=True
-        )
-        key_value = response['Parameter']['Value']
-        key = serialization.load_pem_private_key(
-            key_value.encode('utf8'),
-            password=None,
-            backend=default_backend()
-        )
-        if isinstance(key, rsa.RSAPrivateKey):
-            key_type = "RSA"
-            key_size = key.key_size
-        elif isinstance(key, dsa.DSAPrivateKey):
-            key_type = "DSA"
-            key_size = key.key_size
+def get_renewal_depths(index, due_certificates):
+    """Map the given certificates, and all the certificates that depend on
+    those which are CAs, to their depth in their tree
+
+    A due certificate that depends on a due CA is covered by that CA.
+    Certificates that are not part of a tree are ignored.
+    """
+    due_names = set(certificate.cert_parameter_name for certificate in due_certificates)
+    depths = {}
+    for certificate in due_certificates:
+        ancestors = get_ancestors(index, certificate)
+        if ancestors is None:
+            print(f"WARNING: Certificate {certificate.cert_parameter_name} is due for renewal but is not part of any tree; ignored")
+            continue
+        if any(ancestor.is_ca and ancestor.cert_parameter_name in due_names for ancestor in ancestors):
+            continue
+        depth = len(ancestors)
+        if certificate.is_ca:
+            print(f"Certificate {certificate.cert_parameter_name} is due for renewal and is a CA; propagating to dependent certificates")
+            for dependent_certificate, parent, relative_depth in walk_forest(index, [certificate]):
+                depths[dependent_certificate] = depth + relative_depth
         else:
-            raise ValueError(f"Unhandled private key type for {cert_parameter_name}")
+            depths[certificate] = depth
+    return depths
 
-        # Calculate validity duration
-        cert = certificate.cert
-        validity_delta = cert.not_valid_after - cert.not_valid_before
-        validity_days = validity_delta.days
 
-        # Get tags for key and certificate parameters
-        response = ssm.list_tags_for_resource(
-            ResourceType="Parameter",
-            ResourceId=key_parameter_name
+def get_levelled_horizon_days(how_many_days_left_before_renewing):
+    """Get `RENEWAL_HORIZON_DAYS` in "levelled" mode, or `None` in
+    "threshold" mode (see the `RENEWAL_SCHEDULING` environment variable)
+    """
+    scheduling = os.environ.get('RENEWAL_SCHEDULING', "threshold")
+    if scheduling == "threshold":
+        return None
+    if scheduling == "levelled":
+        horizon_days = int(os.environ['RENEWAL_HORIZON_DAYS'])
+        if horizon_days < how_many_days_left_before_renewing:
+            raise ValueError(f"RENEWAL_HORIZON_DAYS must not be lower than {how_many_days_left_before_renewing}")
+        return horizon_days
+    raise ValueError(f"Invalid RENEWAL_SCHEDULING: {scheduling}")
+
+
+def get_levelled_renewal_date(certificate, how_many_days_left_before_renewing, horizon_days):
+    """Compute the date from which the given certificate is due for early
+    renewal in "levelled" mode
+
+    The number of days before expiry is spread uniformly between
+    `how_many_days_left_before_renewing` and `horizon_days` according to a
+    hash of the certificate's parameter name, so that certificates that
+    expire at the same time are renewed over several runs, and always on the
+    same run for a given expiry date.
+    """
+    digest = hashlib.blake2b(certificate.cert_parameter_name.encode('utf8'), digest_size=8).digest()
+    jitter = int.from_bytes(digest, "big") / 2**64
+    days = how_many_days_left_before_renewing + jitter * (horizon_days - how_many_days_left_before_renewing)
+    return certificate.not_valid_after - datetime.timedelta(days=days + 1)
+
+
+def get_ancestors(index, certificate):
+    """Return the list of ancestors of the given certificate, starting with
+    its CA certificate and ending with the root certificate
+
+    Returns `None` if the certificate is not part of a tree, i.e. it is an
+    orphan (one of its ancestors is missing) or part of a cycle.
+    """
+    ancestors = []
+    seen = {certificate.cert_parameter_name}
+    current = certificate
+    while not current.is_root:
+        parent = index.by_name.get(current.ca_cert_parameter_name)
+        if parent is None:
+            print(f"WARNING: CA certificate {current.ca_cert_parameter_name} of certificate {current.cert_parameter_name} not found")
+            return None
+        if parent.cert_parameter_name in seen:
+            print(f"WARNING: Certificate {parent.cert_parameter_name} is part of a cycle of CA certificates")
+            return None
+        ancestors.append(parent)
+        seen.add(parent.cert_parameter_name)
+        current = parent
+    return ancestors
+
+
+def walk_forest(index, root_certificates):
+    """Walk the trees rooted on `root_certificates`, one tree after the
+    other
+
+    Each tree is walked breadth-first without recursion, so the depth of a CA
+    chain is not limited by the Python stack. This generator yields
+    `(certificate, parent, depth)` tuples, where `parent` is `None` and
+    `depth` is 0 for the root of each tree.
+    """
+    visited = set()
+    for root_certificate in root_certificates:
+        if root_certificate.cert_parameter_name in visited:
+            continue
+        visited.add(root_certificate.cert_parameter_name)
+        yield root_certificate, None, 0
+
+        queue = collections.deque([(root_certificate, 0)])
+        while queue:
+            certificate, depth = queue.popleft()
+            for child in index.get_children(certificate):
+                if child.cert_parameter_name in visited:
+                    print(f"WARNING: Certificate {child.cert_parameter_name} has already been visited; cycle detected under {certificate.cert_parameter_name}")
+                    continue
+                visited.add(child.cert_parameter_name)
+                yield child, certificate, depth + 1
+                queue.append((child, depth + 1))
+
+
+def serialize(plan):
+    """Serialize the certificates of the given `plan` in a list of
+    dictionaires that can be turned into JSON.
+    """
+    return list(iter_plan(plan))
+
+
+def iter_plan(plan):
+    """Generator yielding the serialized form of the certificates of the
+    given `plan`, a list of `(target, ssm, entries)` tuples where `entries`
+    is a list of `(certificate, depth)` tuples
+
+    The certificates are yielded one depth after the other, across all
+    targets (see `get_plan_levels()`), with a `Depth` field. Certificates of
+    a target other than the default one get a `Target` field, so that they
+    are renewed in the right account and region.
+    """
+    for depth in sorted(set(depth for target, ssm, entries in plan for certificate, depth in entries)):
+        for target, ssm, entries in plan:
+            target_field = {k: v for k, v in target.items() if k != 'Paths'}
+            certificates = [certificate for certificate, d in entries if d == depth]
+            for item in iter_serialized(ssm, certificates):
+                item['Depth'] = depth
+                if target_field:
+                    item['Target'] = target_field
+                yield item
+
+
+def get_plan_levels(plan, max_batches):
+    """Describe the levels of the given `plan` in the order of `iter_plan()`
+
+    Each level is the range of the certificates of a given depth, split into
+    at most `max_batches` batches of consecutive certificates. The
+    certificates of a level don't depend on each other, so the batches can be
+    renewed concurrently, once the previous levels are renewed.
+    """
+    counts = collections.Counter(depth for target, ssm, entries in plan for certificate, depth in entries)
+    levels = []
+    start = 0
+    for depth in sorted(counts):
+        count = counts[depth]
+        batch_count = min(max_batches, count)
+        batches = []
+        batch_start = start
+        for i in range(batch_count):
+            batch_end = start + (count * (i + 1)) // batch_count
+            batches.append({'Start': batch_start, 'End': batch_end})
+            batch_start = batch_end
+        levels.append({
+            'Depth': depth,
+            'Start': start,
+            'End': start + count,
+            'Batches': batches
+        })
+        start += count
+    return levels
+
+
+def iter_serialized(ssm, certificates):
+    """Generator yielding the serialized form of each of the given
+    `Certificate` objects, in the same order.
+
+    The certificates are processed `SERIALIZE_CHUNK_SIZE` at a time. For each
+    chunk, the certificates (and the private keys if `VERIFY_PRIVATE_KEYS` is
+    set) are fetched in batches and the tags are listed concurrently.
+
+    If `REUSE_LEAF_KEYS` is set, the `ReuseKey` field of the certificates
+    that are not CAs is set.
+    """
+    verify_private_keys = os.environ.get('VERIFY_PRIVATE_KEYS', "false").lower() == "true"
+    reuse_leaf_keys = os.environ.get('REUSE_LEAF_KEYS', "false").lower() == "true"
+    for i in range(0, len(certificates), SERIALIZE_CHUNK_SIZE):
+        chunk = certificates[i:i + SERIALIZE_CHUNK_SIZE]
+        cert_parameter_names = [certificate.cert_parameter_name for certificate in chunk]
+        key_parameter_names = [certificate.key_parameter_name for certificate in chunk]
+        if verify_private_keys:
+            values = fetch_parameter_values(ssm, cert_parameter_names + key_parameter_names, with_decryption=True)
+        else:
+            values = fetch_parameter_values(ssm, cert_parameter_names)
+
+        tags = list_parameters_tags(ssm, key_parameter_names + cert_parameter_names)
+
+        for certificate in chunk:
+            item = serialize_certificate(
+                certificate,
+                load_certificate(values[certificate.cert_parameter_name]),
+                values.get(certificate.key_parameter_name) if verify_private_keys else None,
+                tags[certificate.key_parameter_name],
+                tags[certificate.cert_parameter_name]
+            )
+            if reuse_leaf_keys and not item.get('BasicConstraints', {}).get('CA', False):
+                item['ReuseKey'] = True
+            yield item
+
+
+def fetch_parameter_values(ssm, names, with_decryption=False):
+    """Fetch the values of the given SSM parameters, 10 at a time
+
+    Returns a dictionary mapping parameter names to their values.
+    """
+    unique_names = list(dict.fromkeys(names))
+    values = {}
+    for i in range(0, len(unique_names), SSM_GET_PARAMETERS_MAX):
+        batch = unique_names[i:i + SSM_GET_PARAMETERS_MAX]
+        print(f"Fetching parameters {batch}")
+        response = ssm.get_parameters(
+            Names=batch,
+            WithDecryption=with_decryption
         )
-        key_tags = response['TagList']
+        if response['InvalidParameters']:
+            raise KeyError(f"Parameters not found: {response['InvalidParameters']}")
+        for parameter in response['Parameters']:
+            values[parameter['Name']] = parameter['Value']
+    return values
+
+
+def list_parameters_tags(ssm, names):
+    """List the tags of the given SSM parameters using a bounded pool of
+    threads
+
+    Returns a dictionary mapping parameter names to their tag lists.
+    """
+    unique_names = list(dict.fromkeys(names))
+
+    def list_tags(name):
         response = ssm.list_tags_for_resource(
             ResourceType="Parameter",
-            ResourceId=cert_parameter_name
+            ResourceId=name
         )
-        cert_tags = response['TagList']
+        return response['TagList']
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=get_max_concurrency()) as executor:
+        tag_lists = executor.map(list_tags, unique_names)
+        return dict(zip(unique_names, tag_lists))
+
+
+def serialize_certificate(certificate, cert, key_value, key_tags, cert_tags):
+    """Serialize a `Certificate` object and its X.509 certificate `cert` in a
+    dictionary that can be turned into JSON.
+
+    If the PEM-encoded private key `key_value` is given, it is checked
+    against the certificate's public key.
+    """
+    # Inspect public key to determine key type and size
+    key_parameter_name = certificate.key_parameter_name
+    cert_parameter_name = certificate.cert_parameter_name
+    public_key = cert.public_key()
+    curve = None
+    if isinstance(public_key, rsa.RSAPublicKey):
+        key_type = "RSA"
+        key_size = public_key.key_size
+    elif isinstance(public_key, dsa.DSAPublicKey):
+        key_type = "DSA"
+        key_size = public_key.key_size
+    elif isinstance(public_key, ec.EllipticCurvePublicKey):
+        key_type = "EC"
+        key_size = None
+        if public_key.curve.name not in EC_CURVE_NAMES:
+            raise ValueError(f"Unhandled elliptic curve {public_key.curve.name} for {cert_parameter_name}")
+        curve = EC_CURVE_NAMES[public_key.curve.name]
+    elif isinstance(public_key, ed25519.Ed25519PublicKey):
+        key_type = "Ed25519"
+        key_size = None
+    else:
+        raise ValueError(f"Unhandled public key type for {cert_parameter_name}")
 
-        # Build serialized item
+    if key_value is not None:
+        verify_private_key(key_value, public_key, key_parameter_name, cert_parameter_name)
 
-        item = {
-            'KeyType': key_type,
-            'KeySize': key_size,
-            'ValidityDays': validity_days,
+    # Calculate validity duration
+    validity_delta = cert.not_valid_after - cert.not_valid_before
+    validity_days = validity_delta.days
+
+    # Build serialized item
+
+    item = {
+        'KeyType': key_type
+    }
+    if key_size is not None:
+        item['KeySize'] = key_size
+    if curve is not None:
+        item['Curve'] = curve
+    item['ValidityDays'] = validity_days
+
+    add_subject_attribute_if_present(item, 'CountryName', cert.subject, NameOID.COUNTRY_NAME)
+    add_subject_attribute_if_present(item, 'StateOrProvinceName', cert.subject, NameOID.STATE_OR_PROVINCE_NAME)
+    add_subject_attribute_if_present(item, 'LocalityName', cert.subject, NameOID.LOCALITY_NAME)
+    add_subject_attribute_if_present(item, 'OrganizationName', cert.subject, NameOID.ORGANIZATION_NAME)
+    add_subject_attribute_if_present(item, 'OrganizationalUnitName', cert.subject, NameOID.ORGANIZATIONAL_UNIT_NAME)
+    add_subject_attribute_if_present(item, 'EmailAddress', cert.subject, NameOID.EMAIL_ADDRESS)
+
+    try:
+        san = cert.extensions.get_extension_for_oid(ExtensionOID.SUBJECT_ALTERNATIVE_NAME)
+        tmp = {
+            'Critical': san.critical,
+            'DNS': []
         }
+        for name in san.value.get_values_for_type(x509.DNSName):
+            tmp['DNS'].append(name)
+        item['SubjectAlternativeName'] = tmp
+    except x509.ExtensionNotFound:
+        pass
 
-        add_subject_attribute_if_present(item, 'CountryName', cert.subject, NameOID.COUNTRY_NAME)
-        add_subject_attribute_if_present(item, 'StateOrProvinceName', cert.subject, NameOID.STATE_OR_PROVINCE_NAME)
-        add_subject_attribute_if_present(item, 'LocalityName', cert.subject, NameOID.LOCALITY_NAME)
-        add_subject_attribute_if_present(item, 'OrganizationName', cert.subject, NameOID.ORGANIZATION_NAME)
-        add_subject_attribute_if_present(item, 'OrganizationalUnitName', cert.subject, NameOID.ORGANIZATIONAL_UNIT_NAME)
-        add_subject_attribute_if_present(item, 'EmailAddress', cert.subject, NameOID.EMAIL_ADDRESS)
-
-        try:
-            san = cert.extensions.get_extension_for_oid(ExtensionOID.SUBJECT_ALTERNATIVE_NAME)
-            tmp = {
-                'Critical': san.critical,
-                'DNS': []
-            }
-            for name in san.value.get_values_for_type(x509.DNSName):
-                tmp['DNS'].append(name)
-            item['SubjectAlternativeName'] = tmp
-        except x509.ExtensionNotFound:
-            pass
-
-        try:
-            basic_constraints = cert.extensions.get_extension_for_oid(ExtensionOID.BASIC_CONSTRAINTS)
-            tmp = {
-                'Critical': basic_constraints.critical,
-                'CA': basic_constraints.value.ca
-            }
-            if basic_constraints.value.path_length is not None:
-                tmp['PathLength'] = basic_constraints.value.path_length
-            item['BasicConstraints'] = tmp
-        except x509.ExtensionNotFound:
-            pass
-
-        try:
-            key_usage = cert.extensions.get_extension_for_oid(ExtensionOID.KEY_USAGE)
-            tmp = {
-                'Critical': key_usage.critical
-            }
-            usages = []
-            if key_usage.value.digital_signature:
-                usages.append("DigitalSignature")
-            if key_usage.value.content_commitment:
-                usages.append("ContentCommitment")
-            if key_usage.value.key_encipherment:
-                usages.append("KeyEncipherment")
-            if key_usage.value.data_encipherment:
-                usages.append("DataEncipherment")
-            if key_usage.value.key_cert_sign:
-                usages.append("KeyCertSign")
-            if key_usage.value.crl_sign:
-                usages.append("CrlSign")
-            if key_usage.value.key_agreement:
-                usages.append("KeyAgreement")
-                # NB: `encipher_only` and `decipher_only` are present only if
-                #     `key_agreement` is set to `True`
-                if key_usage.value.encipher_only:
-                    usages.append("EncipherOnly")
-                if key_usage.value.decipher_only:
-                    usages.append("DecipherOnly")
-            tmp['Usages'] = usages
-            item['KeyUsage'] = tmp
-        except x509.ExtensionNotFound:
-            pass
-
-        if certificate.ca_key_parameter_name:
-            item['SelfSigned'] = False
-            item['CaKeyParameterName'] = certificate.ca_key_parameter_name
-            item['CaCertParameterName'] = certificate.ca_cert_parameter_name
-        else:
-            item['SelfSigned'] = True
+    try:
+        basic_constraints = cert.extensions.get_extension_for_oid(ExtensionOID.BASIC_CONSTRAINTS)
+        tmp = {
+            'Critical': basic_constraints.critical,
+            'CA': basic_constraints.value.ca
+        }
+        if basic_constraints.value.path_length is not None:
+            tmp['PathLength'] = basic_constraints.value.path_length
+        item['BasicConstraints'] = tmp
+    except x509.ExtensionNotFound:
+        pass
+
+    try:
+        key_usage = cert.extensions.get_extension_for_oid(ExtensionOID.KEY_USAGE)
+        tmp = {
+            'Critical': key_usage.critical
+        }
+        usages = []
+        if key_usage.value.digital_signature:
+            usages.append("DigitalSignature")
+        if key_usage.value.content_commitment:
+            usages.append("ContentCommitment")
+        if key_usage.value.key_encipherment:
+            usages.append("KeyEncipherment")
+        if key_usage.value.data_encipherment:
+            usages.append("DataEncipherment")
+        if key_usage.value.key_cert_sign:
+            usages.append("KeyCertSign")
+        if key_usage.value.crl_sign:
+            usages.append("CrlSign")
+        if key_usage.value.key_agreement:
+            usages.append("KeyAgreement")
+            # NB: `encipher_only` and `decipher_only` are present only if
+            #     `key_agreement` is set to `True`
+            if key_usage.value.encipher_only:
+                usages.append("EncipherOnly")
+            if key_usage.value.decipher_only:
+                usages.append("DecipherOnly")
+        tmp['Usages'] = usages
+        item['KeyUsage'] = tmp
+    except x509.ExtensionNotFound:
+        pass
+
+    if certificate.ca_key_parameter_name:
+        item['SelfSigned'] = False
+        item['CaKeyParameterName'] = certificate.ca_key_parameter_name
+        item['CaCertParameterName'] = certificate.ca_cert_parameter_name
+    else:
+        item['SelfSigned'] = True
 
-        item['KeyParameterName'] = key_parameter_name
-        item['CertParameterName'] = cert_parameter_name
-        item['KeyTags'] = key_tags
-        item['CertTags'] = cert_tags
+    item['KeyParameterName'] = key_parameter_name
+    item['CertParameterName'] = cert_parameter_name
+    if certificate.chain_parameter_name:
+        item['ChainParameterName'] = certificate.chain_parameter_name
+    item['KeyTags'] = key_tags
+    item['CertTags'] = cert_tags
 
-        # Add this item to the list
-        output.append(item)
-    return output
+    return item
+
+
+def verify_private_key(key_value, public_key, key_parameter_name, cert_parameter_name):
+    key = serialization.load_pem_private_key(
+        key_value.encode('utf8'),
+        password=None,
+        backend=default_backend()
+    )
+    public_bytes_format = (serialization.Encoding.DER, serialization.PublicFormat.SubjectPublicKeyInfo)
+    if key.public_key().public_bytes(*public_bytes_format) != public_key.public_bytes(*public_bytes_format):
+        raise ValueError(f"Private key {key_parameter_name} doesn't match certificate {cert_parameter_name}")
 
 
 def add_subject_attribute_if_present(item, key, subject, name_oid):
@@ -21,5 +21,5 @@ cd "$tmpdir"
 zip -r9 "../${lambda}.zip" .
 cd ..
 rm -rf "$tmpdir"
-zip -g "${lambda}.zip" *.py
+zip -g "${lambda}.zip" "${lambda}.py"
 zip -gj "${lambda}.zip" ../certificate_resource/libarkcert.py
@@ -1,11 +1,35 @@
 import boto3
 import botocore
+import botocore.exceptions
+import collections
+import gzip
 import json
-from libarkcert import create_or_renew_cert
+import math
+import os
+import time
+from libarkcert import create_or_renew_cert, make_target_session, KeyGenerator, PhaseStats, PhaseTimer
+
+
+# Time to keep in reserve at the end of an invocation, in seconds
+DEFAULT_SAFETY_MARGIN_SECONDS = 10
+
+# Memory size that gives one vCPU to a Lambda function, in MB
+LAMBDA_MEMORY_SIZE_PER_VCPU = 1769
+
+# Maximum number of S3 objects of lists of certificates to renew kept in
+# `plan_cache`
+PLAN_CACHE_MAX_OBJECTS = 32
+
+# S3 objects of lists of certificates to renew, split in lines (NDJSON) or
+# parsed (JSON), kept across the invocations of a warm Lambda container:
+# `{(bucket, key): (etag, content)}`, least recently used first
+plan_cache = collections.OrderedDict()
+plan_cache_stats = {'Hits': 0, 'Misses': 0}
 
 
 def handler(event, context):
-    """Renew the given certificate.
+    """Renew the given certificate, and as many of the following ones as
+    the remaining execution time allows.
 
     NB: This Lambda function is meant to be part of the `renew_certificates`
         state machine.
@@ -15,15 +39,67 @@ def handler(event, context):
         {
           "CertList": {
             "S3Bucket": "XYZ",  # Bucket that contains the list of certificates to renew
-            "S3Key": "XYZ",     # Key to the JSON file that contains the list of certificates to renew
+            "S3Key": "XYZ",     # Key to the JSON file that contains the list of certificates to renew;
+                                # NDJSON if the key ends in ".ndjson", gzipped NDJSON if it ends in ".ndjson.gz";
+                                # if the JSON file contains an object, it is the index of a sharded list
             "Count": 17         # Length of the above list
           },
           "Iter": {
             "Index": 3,          # Index in the above list of the certificate to renew
+            "End": 9,            # Index at which to stop; optional, default to `Count`
             "IsFinished": false  # Whether all the certificates have been renewed or not
-          }
+          },
+          "ExecutionId": "XYZ"   # ARN of the state machine execution; optional
         }
 
+    The `End` field allows to renew a batch of the list, eg: one of the
+    batches of a level of the list, as computed by the `check_certificates`
+    Lambda function.
+
+    If the certificate to renew has a `Target` field (see the
+    `check_certificates` Lambda function), it is renewed in the account and
+    region of that target.
+
+    After each certificate, the next one is renewed only if the remaining
+    execution time, minus a safety margin, is longer than the longest
+    renewal so far. The safety margin is set in seconds by the optional
+    `SAFETY_MARGIN_SECONDS` environment variable; default to 10.
+
+    The private keys of the next certificates are generated in the
+    background, by as many processes as this Lambda function has vCPUs (or
+    the number set by the optional `KEYGEN_WORKERS` environment variable).
+    DSA keys are generated from domain parameters saved under the SSM path
+    set by the optional `DSA_PARAMETERS_PATH` environment variable, which
+    are generated once per key size.
+
+    If a renewal fails after at least one certificate has been renewed, the
+    error is logged and the output points to the failed certificate, so it
+    is retried (and fails for good) in the next invocation.
+
+    The time spent in each phase of each renewal is logged as a JSON record
+    of type "CertificateTimings" by `libarkcert`, with the time spent
+    fetching the list of certificates ("PlanFetch") and waiting for the
+    private key ("KeyWait"). The record of a failed renewal is logged too,
+    with an "Error" field and the phases completed before the failure. At
+    the end of the invocation, the percentiles of the durations of the
+    successful renewals are logged as a JSON record of type
+    "CertificateTimingsSummary".
+
+    NB: The summary only covers the certificates renewed by this invocation,
+        not the whole run of the state machine. The records carry the
+        `ExecutionId` of the input, if any, so the percentiles of a run can
+        be computed from the records with a CloudWatch Logs Insights query
+        on the log group of this Lambda function, eg:
+
+            filter Type = "CertificateTimings" and ExecutionId = "XYZ" and not ispresent(Error)
+            | stats count(*) as Count,
+                    pct(TotalMs, 50) as P50Ms,
+                    pct(TotalMs, 90) as P90Ms,
+                    pct(TotalMs, 99) as P99Ms,
+                    max(TotalMs) as MaxMs
+
+        (use `PhasesMs.CaFetch` etc. instead of `TotalMs` for the phases).
+
     This Lambda function returns something like this:
 
         {
@@ -34,6 +110,7 @@ def handler(event, context):
           },
           "Iter": {
             "Index": 17,        # Index of next certificate to renew
+            "End": 17,          # Copy of the input, if present
             "IsFinished": true  # Whether all the certificates have been renewed or not
           }
         }
@@ -41,39 +118,193 @@ def handler(event, context):
 
     print(f"Received event: {event}")
 
-    # Retrieve list of certificates to renew
-    s3 = boto3.client("s3")
-    response = s3.get_object(
-        Bucket = event['CertList']['S3Bucket'],
-        Key=event['CertList']['S3Key']
-    )
-    data = response['Body'].read().decode('utf8')
-    cert_list = json.loads(data)
-
     # Sanity checks
-    if event['Iter']['IsFinished'] or event['Iter']['Index'] >= event['CertList']['Count']:
+    if event['Iter']['IsFinished'] or event['Iter']['Index'] >= get_end(event):
         print(f"Nothing to do")
         return build_output(event)
 
-    # Renew certificate
-    args = cert_list[event['Iter']['Index']]
-    create_or_renew_cert(args)
+    safety_margin_millis = 1000 * int(os.environ.get('SAFETY_MARGIN_SECONDS', DEFAULT_SAFETY_MARGIN_SECONDS))
+    s3 = boto3.client("s3")
+    objects = {}
+    sessions = {}
+    index = event['Iter']['Index']
+    end = get_end(event)
+    renewed_count = 0
+    longest_millis = 0
+    # NB: Without a context, only one certificate is renewed
+    keygen = KeyGenerator(get_keygen_workers() if context is not None else 1)
+    phase_stats = PhaseStats()
+    timer_fields = {'ExecutionId': event['ExecutionId']} if 'ExecutionId' in event else {}
+    try:
+        while index + renewed_count < end:
+            start = time.monotonic()
+            timer = PhaseTimer(**timer_fields)
+            args = {}
+            try:
+                # Retrieve the certificate to renew
+                args = get_cert_list_item(
+                    s3,
+                    event['CertList']['S3Bucket'],
+                    event['CertList']['S3Key'],
+                    index + renewed_count,
+                    objects
+                )
+                timer.lap("PlanFetch")
+
+                # Generate its private key and those of the next certificates
+                # in the background, unless their existing keys are reused
+                for next_index in range(index + renewed_count, min(index + renewed_count + keygen.workers, end)):
+                    next_args = get_cert_list_item(
+                        s3,
+                        event['CertList']['S3Bucket'],
+                        event['CertList']['S3Key'],
+                        next_index,
+                        objects
+                    )
+                    if not next_args.get('ReuseKey', False):
+                        keygen.prefetch(
+                            next_index,
+                            next_args.get('KeyType', "RSA"),
+                            int(next_args['KeySize']) if 'KeySize' in next_args else None,
+                            next_args.get('Curve')
+                        )
+                key = keygen.get(index + renewed_count)
+                timer.lap("KeyWait")
+
+                # Renew certificate, in the account and region it belongs to
+                args = dict(args)
+                session = None
+                if 'Target' in args:
+                    target = args.pop('Target')
+                    target_key = json.dumps(target, sort_keys=True)
+                    if target_key not in sessions:
+                        sessions[target_key] = make_target_session(target, "renew-certificate")
+                    session = sessions[target_key]
+                create_or_renew_cert(args, session, key, timer)
+            except Exception as e:
+                print(json.dumps(timer.get_record(
+                    Type="CertificateTimings",
+                    CertParameterName=args.get('CertParameterName'),
+                    Error=str(e)
+                )))
+                if renewed_count == 0:
+                    raise
+                print(f"ERROR: Failed to renew certificate {index + renewed_count}, will retry in the next invocation: {e}")
+                break
+            renewed_count += 1
+            phase_stats.add(timer)
+
+            # Check whether there is enough time left to renew another certificate
+            longest_millis = max(longest_millis, 1000 * (time.monotonic() - start))
+            if context is None or context.get_remaining_time_in_millis() - safety_margin_millis < longest_millis:
+                break
+    finally:
+        keygen.close()
 
     # Done
-    return build_output(event)
+    print(f"Renewed {renewed_count} certificates; longest renewal: {longest_millis / 1000:.1f}s")
+    print(json.dumps(dict(
+        timer_fields,
+        Type="CertificateTimingsSummary",
+        Count=renewed_count,
+        Phases=phase_stats.get_summary()
+    )))
+    print(f"Plan cache: {plan_cache_stats['Hits']} hits, {plan_cache_stats['Misses']} misses since the container started")
+    return build_output(event, renewed_count)
 
 
-def build_output(event):
-    index = event['Iter']['Index']
-    count = event['CertList']['Count']
-    if index < count:
-        index += 1
+def get_cert_list_item(s3, bucket, key, index, objects=None):
+    """Get the item at `index` in the list of certificates to renew stored in
+    S3, either as a JSON array, as NDJSON (one JSON object per line) or as
+    the JSON index of a sharded list
+
+    For a sharded list, only the index and the shard containing the item are
+    fetched. The S3 objects are loaded with `load_plan_object()`, and kept in
+    the `objects` dict if given, so that consecutive items are loaded only
+    once.
+
+    NB: The item returned must not be modified, as it may be cached.
+    """
+    if objects is None:
+        objects = {}
+    if key not in objects:
+        objects[key] = load_plan_object(s3, bucket, key)
+    cert_list = objects[key]
+
+    if isinstance(cert_list, dict):
+        shard_size = cert_list['ShardSize']
+        shard_key = cert_list['Shards'][index // shard_size]
+        print(f"Certificate {index} is in shard {shard_key}")
+        return get_cert_list_item(s3, bucket, shard_key, index % shard_size, objects)
+    if index >= len(cert_list):
+        raise IndexError(f"Certificate list s3://{bucket}/{key} has no item at index {index}")
+    item = cert_list[index]
+    if isinstance(item, bytes):
+        # NB: Only the NDJSON lines we need are parsed
+        item = json.loads(item.decode('utf8'))
+    return item
+
+
+def load_plan_object(s3, bucket, key):
+    """Load an S3 object of a list of certificates to renew, split in lines
+    (NDJSON) or parsed (JSON)
+
+    If the object is in `plan_cache`, it is only downloaded again if its
+    ETag changed.
+    """
+    cached = plan_cache.get((bucket, key))
+    kwargs = {}
+    if cached:
+        kwargs['IfNoneMatch'] = cached[0]
+    try:
+        response = s3.get_object(Bucket=bucket, Key=key, **kwargs)
+    except botocore.exceptions.ClientError as e:
+        # NB: S3 answers "304 Not Modified" when the ETag matches
+        if cached and e.response['Error']['Code'] in ("304", "NotModified"):
+            plan_cache_stats['Hits'] += 1
+            plan_cache.move_to_end((bucket, key))
+            return cached[1]
+        raise
+    plan_cache_stats['Misses'] += 1
+
+    data = response['Body'].read()
+    if key.endswith(".gz"):
+        data = gzip.decompress(data)
+    if key.endswith(".ndjson") or key.endswith(".ndjson.gz"):
+        content = data.splitlines()
     else:
-        index = count
+        content = json.loads(data.decode('utf8'))
+
+    plan_cache[(bucket, key)] = (response['ETag'], content)
+    plan_cache.move_to_end((bucket, key))
+    while len(plan_cache) > PLAN_CACHE_MAX_OBJECTS:
+        plan_cache.popitem(last=False)
+    return content
+
+
+def get_keygen_workers():
+    """Get the number of processes generating private keys in the background
+
+    Lambda gives one vCPU per `LAMBDA_MEMORY_SIZE_PER_VCPU` MB of memory.
+    """
+    if 'KEYGEN_WORKERS' in os.environ:
+        return int(os.environ['KEYGEN_WORKERS'])
+    memory_size = int(os.environ.get('AWS_LAMBDA_FUNCTION_MEMORY_SIZE', LAMBDA_MEMORY_SIZE_PER_VCPU))
+    return min(os.cpu_count() or 1, math.ceil(memory_size / LAMBDA_MEMORY_SIZE_PER_VCPU))
+
+
+def get_end(event):
+    return min(event['Iter'].get('End', event['CertList']['Count']), event['CertList']['Count'])
+
+
+def build_output(event, renewed_count=1):
+    index = event['Iter']['Index']
+    end = get_end(event)
+    index = min(index + renewed_count, end)
 
     output = event
     output['Iter']['Index'] = index
-    output['Iter']['IsFinished'] = index >= count
+    output['Iter']['IsFinished'] = index >= end
     if 'CloudFormationData' in event:
         output['CloudFormationData'] = event['CloudFormationData']
     print(f"Output: {output}")
@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+
+# Renew a list of certificates with stubbed S3 and STS clients, and check in
+# which account and region each certificate is renewed (no AWS account is
+# needed)
+#
+# NB: `libarkcert` is packaged with the Lambda function, see
+#     `custom-package.sh`
+
+import datetime
+import io
+import json
+import os
+import sys
+
+import boto3
+import botocore.response
+from botocore.stub import Stubber
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "certificate_resource"))
+import renew_certificate
+
+TARGET = {
+    'RoleArn': "arn:aws:iam::210987654321:role/pki-renewals",
+    'ExternalId': "xyz",
+    'Region': "eu-west-1"
+}
+
+
+class Context:
+    def get_remaining_time_in_millis(self):
+        return 900000
+
+
+def make_stubbed_client(service):
+    client = boto3.session.Session(
+        aws_access_key_id="testing",
+        aws_secret_access_key="testing",
+        region_name="us-east-1"
+    ).client(service)
+    stubber = Stubber(client)
+    stubber.activate()
+    return client, stubber
+
+
+def stub_plan(stubber, key, plan):
+    body = json.dumps(plan).encode('utf8')
+    stubber.add_response(
+        "get_object",
+        {'Body': botocore.response.StreamingBody(io.BytesIO(body), len(body)), 'ETag': '"1"'},
+        {'Bucket': "b", 'Key': key}
+    )
+
+
+def record_renewal(args, session=None, key=None, timer=None):
+    renewals.append((args['CertParameterName'], session))
+
+
+s3, s3_stubber = make_stubbed_client("s3")
+sts, sts_stubber = make_stubbed_client("sts")
+clients = {'s3': s3, 'sts': sts}
+renew_certificate.boto3.client = lambda service, **kwargs: clients[service]
+renew_certificate.create_or_renew_cert = record_renewal
+renew_certificate.print = lambda *args, **kwargs: None
+os.environ['KEYGEN_WORKERS'] = "1"
+os.environ['SAFETY_MARGIN_SECONDS'] = "0"
+renewals = []
+
+# Two certificates of a target and one of this account: the role of the
+# target is assumed once, and its session is used for both certificates
+
+plan = [
+    {'CertParameterName': "/pki/certs/a", 'Target': TARGET},
+    {'CertParameterName': "/pki/certs/b", 'Target': TARGET},
+    {'CertParameterName': "/pki/certs/c"}
+]
+stub_plan(s3_stubber, "plan.json", plan)
+sts_stubber.add_response(
+    "assume_role",
+    {
+        'Credentials': {
+            'AccessKeyId': "ASIATESTTESTTEST",
+            'SecretAccessKey': "secret",
+            'SessionToken': "token",
+            'Expiration': datetime.datetime(2030, 1, 1)
+        }
+    },
+    {'RoleArn': TARGET['RoleArn'], 'RoleSessionName': "renew-certificate", 'ExternalId': "xyz"}
+)
+event = {'CertList': {'S3Bucket': "b", 'S3Key': "plan.json", 'Count': 3}, 'Iter': {'Index': 0, 'IsFinished': False}}
+output = renew_certificate.handler(event, Context())
+assert output['Iter'] == {'Index': 3, 'IsFinished': True}
+s3_stubber.assert_no_pending_responses()
+sts_stubber.assert_no_pending_responses()
+
+assert [name for name, session in renewals] == ["/pki/certs/a", "/pki/certs/b", "/pki/certs/c"]
+target_session = renewals[0][1]
+assert target_session is renewals[1][1]
+assert target_session.region_name == "eu-west-1"
+assert target_session.get_credentials().access_key == "ASIATESTTESTTEST"
+assert renewals[2][1] is None
+print("Certificates of a target renewed with the session of its role")
+
+print("All tests OK")